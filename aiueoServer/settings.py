@@ -1,3 +1,4 @@
+import socket
 from pathlib import Path
 import environ
 
@@ -17,6 +18,30 @@ env = environ.Env(
     MYSQL_USER=(str, "root"),
     MYSQL_PASSWORD=(str, ""),
     STATIC_URL=(str, "/static/"),
+    DB_POOL_SIZE=(int, 0),                     # 0 表示不启用连接池
+    DB_POOL_TIMEOUT=(int, 10),
+    DB_POOL_RECYCLE=(int, 1800),
+    DB_POOL_PRE_PING=(bool, True),
+    DB_CONN_MAX_AGE=(int, 0),
+    DB_CONN_HEALTH_CHECKS=(bool, True),
+    CHAT_FANOUT_BATCH_SIZE=(int, 100),
+    CHAT_READ_DETAIL_LOG=(bool, False),
+    CHAT_DB_WRITE_WORKERS=(int, 16),
+    CHAT_SYNC_LIMIT=(int, 200),
+    CHAT_META_TTL=(int, 60),
+    CHAT_WRITE_BEHIND=(bool, False),
+    CHAT_WRITE_BEHIND_BATCH=(int, 500),
+    CHAT_WRITE_BEHIND_INTERVAL_MS=(int, 50),
+    CHAT_DEDUPE_TTL=(int, 86400),
+    PRESENCE_ENABLED=(bool, True),
+    PRESENCE_TTL=(int, 90),
+    NODE_ID=(str, ""),
+    CACHE_REDIS_URL=(str, ""),
+    USER_CACHE_SIZE=(int, 10000),
+    USER_CACHE_LOCAL_TTL=(int, 30),
+    USER_CACHE_SHARED_TTL=(int, 600),
+    ROLE_CACHE_LOCAL_TTL=(int, 30),
+    ROLE_CACHE_SHARED_TTL=(int, 3600),
 )
 
 # ---------- 2. 读 .env ----------
@@ -36,12 +61,14 @@ CORS_ALLOW_CREDENTIALS = env("CORS_ALLOW_CREDENTIALS")
 # CORS_ALLOWED_ORIGINS = env.list("CORS_ALLOWED_ORIGINS", default=[])
 
 # ---------- 6. Channel Layers ----------
+CHANNEL_LAYER_REDIS_HOST = env("CHANNEL_LAYER_REDIS_HOST")
+CHANNEL_LAYER_REDIS_PORT = env("CHANNEL_LAYER_REDIS_PORT")
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
             "hosts": [
-                (env("CHANNEL_LAYER_REDIS_HOST"), env("CHANNEL_LAYER_REDIS_PORT")),
+                (CHANNEL_LAYER_REDIS_HOST, CHANNEL_LAYER_REDIS_PORT),
                 # { "password": '030827' }
             ],
         },
@@ -49,18 +76,74 @@ CHANNEL_LAYERS = {
 }
 
 # ---------- 7. MySQL ----------
+# ASGI 下每个请求跑在不同线程，持久连接会按线程堆积；
+# 开启 DB_POOL_SIZE 后改用带连接池的后端，连接用完即还回池里，CONN_MAX_AGE 保持 0 即可
+DB_POOL_SIZE = env("DB_POOL_SIZE")
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.mysql",
+        "ENGINE": "utils.mysql_pool" if DB_POOL_SIZE else "django.db.backends.mysql",
         "NAME": env("MYSQL_NAME"),
         "USER": env("MYSQL_USER"),
         "PASSWORD": env("MYSQL_PASSWORD"),
         "HOST": env("MYSQL_HOST"),
         "PORT": env("MYSQL_PORT"),
         "OPTIONS": {"charset": "utf8mb4"},
+        "CONN_MAX_AGE": env("DB_CONN_MAX_AGE"),
+        "CONN_HEALTH_CHECKS": env("DB_CONN_HEALTH_CHECKS"),
+        "POOL": {
+            "max_size": DB_POOL_SIZE,
+            "timeout": env("DB_POOL_TIMEOUT"),
+            "recycle": env("DB_POOL_RECYCLE"),
+            "pre_ping": env("DB_POOL_PRE_PING"),
+        },
     }
 }
 
+# ---------- 8. 聊天 ----------
+# 群聊收件箱投递时每批并发的 group_send 数
+CHAT_FANOUT_BATCH_SIZE = env("CHAT_FANOUT_BATCH_SIZE")
+# 已读以成员水位 read_up_to_msg_id 为准，开启后额外记录 MessageRead 明细
+CHAT_READ_DETAIL_LOG = env("CHAT_READ_DETAIL_LOG")
+# consumer 写库专用线程数；开启连接池时 DB_POOL_SIZE 应不小于它
+CHAT_DB_WRITE_WORKERS = env("CHAT_DB_WRITE_WORKERS")
+# 重连补推时每帧最多带的消息数，超出由客户端发 sync 帧继续拉
+CHAT_SYNC_LIMIT = env("CHAT_SYNC_LIMIT")
+# consumer 缓存的会话成员最长用多少秒，过期回库重查，兜底丢失的 conv.changed 事件
+CHAT_META_TTL = env("CHAT_META_TTL")
+# 延迟写入：消息先进 Redis 日志并立即广播，后台按 BATCH 条 / INTERVAL_MS 毫秒成批落库
+# 开启后所有发送都走这条链路，Redis 需开启 AOF；client_msg_id 去重记录保留 CHAT_DEDUPE_TTL 秒
+# 所有节点必须一致，不能混跑
+CHAT_WRITE_BEHIND = env("CHAT_WRITE_BEHIND")
+CHAT_WRITE_BEHIND_BATCH = env("CHAT_WRITE_BEHIND_BATCH")
+CHAT_WRITE_BEHIND_INTERVAL_MS = env("CHAT_WRITE_BEHIND_INTERVAL_MS")
+CHAT_DEDUPE_TTL = env("CHAT_DEDUPE_TTL")
+# 在线状态：与 channel layer 共用 Redis，TTL 内没有心跳即视为离线（客户端心跳间隔需小于它）
+PRESENCE_ENABLED = env("PRESENCE_ENABLED")
+PRESENCE_TTL = env("PRESENCE_TTL")
+NODE_ID = env("NODE_ID") or socket.gethostname()
+
+# ---------- 9. 缓存 ----------
+# 配置 CACHE_REDIS_URL 后启用跨进程共享缓存，否则只用进程内缓存
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+}
+SHARED_CACHE_ALIAS = None
+if env("CACHE_REDIS_URL"):
+    CACHES["shared"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": env("CACHE_REDIS_URL"),
+    }
+    SHARED_CACHE_ALIAS = "shared"
+# 认证用户快照缓存：进程内条目数 / 进程内有效期 / 共享缓存有效期（秒）
+USER_CACHE_SIZE = env("USER_CACHE_SIZE")
+USER_CACHE_LOCAL_TTL = env("USER_CACHE_LOCAL_TTL")
+USER_CACHE_SHARED_TTL = env("USER_CACHE_SHARED_TTL")
+# 角色权限集合缓存：进程内有效期 / 共享缓存有效期（秒）
+ROLE_CACHE_LOCAL_TTL = env("ROLE_CACHE_LOCAL_TTL")
+ROLE_CACHE_SHARED_TTL = env("ROLE_CACHE_SHARED_TTL")
+
 INSTALLED_APPS = [
     'channels',
     "django.contrib.auth",
@@ -14,17 +14,39 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.db import connection
 from django.http import HttpResponse
 # from django.contrib import admin
 from django.urls import path, include
 
+from utils.mysql_pool.pool import pool_stats
+from utils.response import error_response, success_response
+
 
 def index(request):
     return HttpResponse("a i u e o")
 
+
+def db_health(request):
+    # 数据库探活 + 连接池指标
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+    except Exception as e:
+        # 异常信息可能带主机、用户名，只记日志不回给调用方
+        print('[health] 数据库探活失败:', e)
+        return error_response(503, '数据库不可用', data={'pool': pool_stats()})
+    return success_response(data={
+        'engine': connection.settings_dict['ENGINE'],
+        'conn_max_age': connection.settings_dict['CONN_MAX_AGE'],
+        'pool': pool_stats(),
+    })
+
 urlpatterns = [
     # path("admin/", admin.site.urls),
     path('', index, name="index"),
+    path('health/db/', db_health, name="db_health"),
     path("user/", include('user.urls')),
     path("chat/", include('chat.urls')),
 ]
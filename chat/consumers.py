@@ -1,103 +1,94 @@
+import asyncio
 import json
 import os
+import time
+from collections import defaultdict
 from datetime import datetime
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.exceptions import StopConsumer
 import django
 from django.forms import ValidationError
+from redis.exceptions import RedisError
 
 from utils.token import decode_refresh_token
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'aiueoServer.settings')
 django.setup()
-from .models import Conversation, Message, MessageRead
+from .db import db_read, db_write
+from .fanout import group_send_batch, publish_inbox
+from . import presence, services, writebehind
+from .models import Conversation, ConversationParticipant
 from user.models import User
-from asgiref.sync import sync_to_async
+from django.conf import settings
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
-    @staticmethod
-    @sync_to_async
-    def save_message(conv_id, sender_id, content, parent_id=None):
-        conv = Conversation.objects.get(pk=conv_id)
-        sender = User.objects.get(pk=sender_id)
-        parent = None
-        if parent_id:
-            parent = Message.objects.filter(pk=parent_id).first()
-        msg = Message.objects.create(
-            conversation=conv,
-            sender=sender,
-            content=content,
-            parent_message=parent
+    @db_write
+    def save_message(self, conv_id, content, parent_id=None, client_msg_id=None):
+        # 整条发送链路只切一次线程，会话元数据用连接内缓存
+        meta, payload, other_uids, created = services.send_message(
+            conv_id, self.user, content, parent_id,
+            meta=self.cached_meta(conv_id),
+            client_msg_id=client_msg_id,
         )
-        return msg
-        # {
-        #     "id": msg.id,
-        #     "conv_id": conv_id,
-        #     "sender_id": sender.user_id,
-        #     "sender_username": sender.username,
-        #     "parent_id": parent.id if parent else None,
-        #     "content": msg.content,
-        #     "timestamp": msg.timestamp.isoformat(),
-        #     "is_recalled": msg.is_recalled,
-        # }
-
-    @staticmethod
-    @sync_to_async
-    def get_read_info(msg: Message, conv: Conversation, user: User):
-        # 1. 自己是否已读
-        me_read = MessageRead.objects.filter(message=msg, user=user).exists()
-        if conv.type == Conversation.PRIVATE:
-            mate_uid = [uid for uid in conv.private_members if uid != user.user_id][0]
-            other_read = MessageRead.objects.filter(message=msg, user_id=mate_uid).exists()
-            return {
-                'is_read': me_read,
-                'is_read_by_other': other_read,
-                'read_count': 0,
-                'readers': [],
-            }
-        else:
-            readers = list(
-                MessageRead.objects
-                .filter(message=msg)
-                .values('user_id', 'user__username')
-            )
-            return {
-                'is_read': me_read,
-                'is_read_by_other': False,
-                'read_count': len(readers),
-                'readers': readers,
-            }
+        self.remember_meta(conv_id, meta)
+        return meta, payload, other_uids, created
 
-    @sync_to_async
-    def get_other_user_id(self, conv_id, me):
-        # 1v1 会话只有两条 participant 记录
-        return Conversation.objects.get(pk=conv_id).participants.exclude(user_id=me).first().user_id
-
-    @sync_to_async
-    def get_other_user_ids(self, conv_id, me) -> list[int]:
-        return list(
-            Conversation.objects.get(pk=conv_id)
-            .participants
-            .exclude(user_id=me)
-            .values_list("user_id", flat=True)
+    async def enqueue_message(self, conv_id, content, parent_id=None, client_msg_id=None):
+        # 延迟写入：Redis 分配 id / seq 后立即返回，由后台线程成批落库
+        meta, payload, other_uids, created = await writebehind.send_message(
+            conv_id, self.user, content, parent_id,
+            meta=self.cached_meta(conv_id),
+            client_msg_id=client_msg_id,
         )
+        self.remember_meta(conv_id, meta)
+        return meta, payload, other_uids, created
+
+    def cached_meta(self, conv_id):
+        # 成员集合靠 conv.changed 事件保持最新；事件可能丢，超过 CHAT_META_TTL 秒回库重查
+        meta = self.conv_meta.get(conv_id)
+        if meta is not None and time.monotonic() - meta['loaded_at'] > settings.CHAT_META_TTL:
+            self.conv_meta.pop(conv_id, None)
+            return None
+        return meta
 
-    @sync_to_async
-    def is_group(self, conv_id) -> bool:
-        return Conversation.objects.get(pk=conv_id).type == 'group'
+    def remember_meta(self, conv_id, meta):
+        # 新查出来的元数据才记加载时间，沿用缓存的不续期
+        if self.conv_meta.get(conv_id) is not meta:
+            meta['loaded_at'] = time.monotonic()
+            self.conv_meta[conv_id] = meta
+
+    async def load_conv_meta(self, conv_id):
+        try:
+            self.remember_meta(conv_id, await services.aload_conv_meta(conv_id))
+        except Conversation.DoesNotExist:
+            pass
+
+    def spawn(self, coro):
+        # 持有后台任务引用，防止被 GC 提前回收
+        if not hasattr(self, 'background_tasks'):
+            self.background_tasks = set()
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
 
     # ---------- 连接 ----------
     async def connect(self):
         # 前端连接 ws/chat/<conv_id>/
         self.conv_id = int(self.scope['url_route']['kwargs']['conv_id'])
         self.room_group = f'chat_{self.conv_id}'
+        self.conv_meta = {}
         await self.validate_user()
         await self.channel_layer.group_add(self.room_group, self.channel_name)
         # 个人收件箱
         self.inbox_group = f'user_{self.user_id}'
         await self.channel_layer.group_add(self.inbox_group, self.channel_name)
+        # 先进房间再加载会话元数据：加载期间的 conv.changed 排在 connect 之后处理，不会丢
+        await self.load_conv_meta(self.conv_id)
         await self.accept()
+        await presence.touch(self.user_id, self.channel_name)
         now = datetime.now()
         now_time = now.strftime("%Y-%m-%d %H:%M:%S")
         print(f'[WS] {self.user_id} 加入房间 {self.room_group} 加入时间 {now_time}')
@@ -109,6 +100,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.channel_layer.group_discard(self.room_group, self.channel_name)
         if hasattr(self, 'inbox_group'):
             await self.channel_layer.group_discard(self.inbox_group, self.channel_name)
+            await presence.leave(self.user_id, self.channel_name)
         now = datetime.now()
         now_time = now.strftime("%Y-%m-%d %H:%M:%S")
         print(f'[WS] {self.channel_name} 离开房间 {self.room_group} 离开时间 {now_time}')
@@ -118,6 +110,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def receive(self, text_data=None, bytes_data=None):
         # 心跳探测
         if text_data == '__ping__':
+            await presence.touch(self.user_id, self.channel_name)
             await self.send('__pong__')
             return
 
@@ -126,77 +119,97 @@ class ChatConsumer(AsyncWebsocketConsumer):
             data = json.loads(text_data)
         except Exception:
             return  # 非法格式直接丢弃
+        await self.handle_frame(self.conv_id, data)
+
+    async def handle_frame(self, conv_id, data):
+        # 按帧类型分发，缺省为聊天消息
+        if data.get('type') == 'mark_read':
+            await self.handle_mark_read(conv_id, data)
+        else:
+            await self.handle_chat(conv_id, data)
+
+    @db_write
+    def advance_read(self, conv_id, up_to_msg_id):
+        participant, receipts = services.advance_read(conv_id, self.user, up_to_msg_id)
+        return participant, services.read_receipts(conv_id, self.user, participant, receipts)
+
+    async def handle_mark_read(self, conv_id, data):
+        # 批量已读：{"type": "mark_read", "up_to_msg_id": 123}
+        try:
+            up_to_msg_id = int(data['up_to_msg_id'])
+            participant, sends = await self.advance_read(conv_id, up_to_msg_id)
+        except (KeyError, TypeError, ValueError, ConversationParticipant.DoesNotExist):
+            return
+        self.spawn(group_send_batch(self.channel_layer, sends))
+        await self.send(text_data=json.dumps({
+            "type": "read_ack",
+            "state": 200,
+            "data": {
+                "conv_id": conv_id,
+                "read_up_to_msg_id": participant.read_up_to_msg_id,
+                "unread": participant.unread_count,
+            },
+        }))
+
+    async def handle_chat(self, conv_id, data):
         content = data.get('text', '').strip()
         if not content:
             return
-        parent_id = data.get("parent_id")  # 可选：回复哪条消息
+        try:
+            parent_id = int(data.get("parent_id") or 0) or None  # 可选：回复哪条消息
+            # 可选：客户端消息 id，断网重发时去重
+            client_msg_id = services.clean_client_msg_id(data.get("client_msg_id"))
+        except ValueError:
+            return
         print(f'[WS] 收到消息：{content}')
 
-        # ---------- 校验是否是好友 ----------
-        conv = await sync_to_async(Conversation.objects.get)(pk=self.conv_id)
-        if conv.type == 'private':
-            if not await self.both_in_private(conv):
-                await self.channel_layer.group_send(
-                    self.inbox_group,
-                    {
-                        "type": "inbox.notify",
-                        "state": 403,
-                        "payload": {
-                            "content": "对方已解除好友，无法发送消息",
-                        },
-                    }
-                )
-                return
-        
-        # 5. 落库（异步）
+        # ---------- 校验 + 落库（一次 DB 往返，延迟写入时不等库） ----------
+        save = self.enqueue_message if settings.CHAT_WRITE_BEHIND else self.save_message
         try:
-            msg_obj = await self.save_message(
-                conv_id=self.conv_id,
-                sender_id=self.user_id,
-                content=content,
-                parent_id=parent_id
+            meta, payload, other_uids, created = await save(
+                conv_id,
+                content,
+                parent_id=parent_id,
+                client_msg_id=client_msg_id,
+            )
+        except services.SendForbidden as e:
+            await self.channel_layer.group_send(
+                self.inbox_group,
+                {
+                    "type": "inbox.notify",
+                    "state": 403,
+                    "payload": {
+                        "content": str(e),
+                    },
+                }
             )
-        except (Conversation.DoesNotExist, User.DoesNotExist, ValidationError) as e:
+            return
+        except (Conversation.DoesNotExist, ValidationError, RedisError) as e:
             # 失败可以给前端一个错误码，这里简单打印
             print("[WS] 落库失败:", e)
             return
 
-        read_info = await self.get_read_info(msg_obj, conv, self.user)
-        payload = {
-            "id": msg_obj.id,
-            "conv_id": self.conv_id,
-            "sender_id": msg_obj.sender.user_id,
-            "sender_username": msg_obj.sender.username,
-            "parent_id": msg_obj.parent_message_id,
-            "content": msg_obj.content,
-            "timestamp": msg_obj.timestamp.isoformat(),
-            "is_recalled": msg_obj.is_recalled,
-            **read_info  # 展开四个已读字段
-        }
+        if not created:
+            # 重发的消息已经广播过，只回给发送方这一条连接
+            await self.chat_message({"state": 200, "payload": payload})
+            return
+
         # 回播给整个房间
         await self.channel_layer.group_send(
-            self.room_group,
+            f'chat_{conv_id}',
             {
                 "type": "chat.message",
                 "state": 200,
                 "payload": payload  # 把完整 dict 发出去
             }
         )
-        # 投到收件箱
-        if await self.is_group(self.conv_id):
-            # 群聊：给所有其他成员推送
-            other_uids = await self.get_other_user_ids(self.conv_id, self.user_id)
-            for uid in other_uids:
-                await self.channel_layer.group_send(
-                    f'user_{uid}',
-                    {"type": "inbox.notify", "state": 200, "payload": payload}
-                )
+        # 投到在线成员的收件箱
+        inbox = publish_inbox(self.channel_layer, other_uids, payload)
+        if meta['type'] == Conversation.GROUP:
+            # 群聊：后台分批投递，不阻塞当前连接处理下一帧
+            self.spawn(inbox)
         else:
-            other_uid = await self.get_other_user_id(self.conv_id, self.user_id)
-            await self.channel_layer.group_send(
-                f'user_{other_uid}',
-                {"type": "inbox.notify", "state": 200, "payload": payload}
-            )
+            await inbox
 
     async def chat_message(self, event):
         # 给客户端发送消息 - 群组
@@ -218,6 +231,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
             },
         }))
 
+    async def conv_changed(self, event):
+        # 成员变动：就地更新缓存的成员集合，不回库
+        meta = self.conv_meta.get(event['conv_id'])
+        if meta is not None:
+            meta['member_ids'] |= set(event['added'])
+            meta['member_ids'] -= set(event['removed'])
+
     async def msg_read(self, event):
         await self.send(text_data=json.dumps({
             "type": "read_receipt",
@@ -225,30 +245,217 @@ class ChatConsumer(AsyncWebsocketConsumer):
             "data": event["data"]
         }))
 
-    @sync_to_async
-    def validate_user(self):
+    @db_read
+    async def validate_user(self):
         r_token = self.scope['cookies']['refresh_token']
         decoded = decode_refresh_token(r_token)
 
         if decoded['state'] == 1:
             self.user_id = decoded['data']['user_id']
-            self.user = User.objects.filter(user_id=self.user_id).first()
+            self.user = await User.objects.filter(user_id=self.user_id).afirst()
         else:
-            return self.send({
-                "state": 401,
-                "msg": '用户身份验证失败'
-            })
-
-    @sync_to_async
-    def both_in_private(self, conv: Conversation) -> bool:
-        """私聊：校验双方是否仍在会话里"""
-        if conv.type != 'private':
-            return True
-        # 私聊：检查两人是否都还在 participants 表里
-        uid1, uid2 = conv.private_members
-        other_id = uid1 if self.user_id != uid1 else uid2
-        return (
-            conv.participants.filter(user_id=self.user_id).exists() and
-            conv.participants.filter(user_id=other_id).exists()
-        )
+            # 身份验证失败，由 connect 按 user 为空处理
+            self.user = None
+
+
+class UserConsumer(ChatConsumer):
+    """
+    多路复用连接：一个用户只建一条 ws，
+    连接时加入其全部会话的房间，收发帧按 conv_id 路由
+    """
+
+    @db_read
+    async def get_conv_ids(self) -> set[int]:
+        return {
+            cid async for cid in
+            ConversationParticipant.objects
+            .filter(user_id=self.user_id)
+            .values_list('conversation_id', flat=True)
+        }
+
+    @db_read
+    async def is_participant(self, conv_id) -> bool:
+        return await ConversationParticipant.objects.filter(
+            conversation_id=conv_id, user_id=self.user_id
+        ).aexists()
+
+    def get_device_id(self):
+        # 游标按设备保存：同一账号多端各自补推，互不推进对方的游标
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        return query.get('device', [''])[0][:64]
+
+    @db_write
+    def save_sync_cursor(self, seqs):
+        services.save_sync_cursor(self.user_id, self.device_id, seqs)
+
+    def note_delivered(self, payload):
+        """
+        实时帧只在 seq 连续时推进游标：广播在提交之后，到达顺序不保证，
+        跳号的先记下，等缺的那条（或补推页）到了再一起推进
+        连接之后才加入的会话不记游标，下次连接时按新会话处理
+        """
+        conv_id, seq = payload.get('conv_id'), payload.get('seq')
+        if conv_id not in self.seqs or seq is None:
+            return
+        if seq > self.seqs[conv_id] + 1:
+            self.pending[conv_id].add(seq)
+            return
+        self.advance(conv_id, seq)
+
+    def advance(self, conv_id, seq):
+        cur = max(self.seqs[conv_id], seq)
+        pending = self.pending.pop(conv_id, set())
+        while cur + 1 in pending:
+            cur += 1
+        pending = {s for s in pending if s > cur}
+        if pending:
+            self.pending[conv_id] = pending
+        self.seqs[conv_id] = cur
+
+    async def start_sync(self):
+        """
+        连接时确定各会话的起点：有游标的从游标补推，
+        没有游标的（首次连接 / 离线期间新加入）从当前 last_seq 开始记，
+        列在 new_convs 里由客户端自己拉历史
+        """
+        saved = await services.aload_sync_cursor(self.user_id, self.device_id)
+        last_seqs = await services.alast_seqs(self.conv_ids)
+        saved = saved or {}
+        self.seqs = {
+            conv_id: saved.get(conv_id, last_seq)
+            for conv_id, last_seq in last_seqs.items()
+        }
+        self.saved_seqs = dict(self.seqs)
+        self.sync_convs = {
+            conv_id for conv_id, last_seq in last_seqs.items()
+            if self.seqs[conv_id] < last_seq
+        }
+        new_convs = sorted(set(last_seqs) - set(saved))
+        await self.send_sync(new_convs)
+
+    async def send_sync(self, new_convs=()):
+        """
+        补推一页漏掉的消息，所有会话合并成一帧
+        在加入房间之后执行，与实时消息可能重复但不会漏，客户端按 id 去重；
+        has_more 时客户端发 {"type": "sync"} 取下一页
+        """
+        cursors = {conv_id: self.seqs[conv_id] for conv_id in self.sync_convs if conv_id in self.seqs}
+        msgs, has_more = await services.amissed_messages(cursors, settings.CHAT_SYNC_LIMIT)
+        await self.send(text_data=json.dumps({
+            "type": "sync",
+            "state": 200,
+            "data": {
+                "msgs": msgs,
+                "has_more": has_more,
+                "new_convs": list(new_convs),
+            },
+        }))
+        # 每页是各会话缺口的连续前缀，发出去之后可以直接推进
+        for msg in msgs:
+            self.advance(msg['conv_id'], msg['seq'])
+        if not has_more:
+            self.sync_convs = set()
+
+    async def join_conv(self, conv_id):
+        self.conv_ids.add(conv_id)
+        await self.channel_layer.group_add(f'chat_{conv_id}', self.channel_name)
+
+    async def leave_conv(self, conv_id):
+        self.conv_ids.discard(conv_id)
+        self.conv_meta.pop(conv_id, None)
+        self.seqs.pop(conv_id, None)
+        self.pending.pop(conv_id, None)
+        self.sync_convs.discard(conv_id)
+        await self.channel_layer.group_discard(f'chat_{conv_id}', self.channel_name)
+
+    # ---------- 连接 ----------
+    async def connect(self):
+        # 前端连接 ws/chat/channel/
+        self.conv_ids = set()
+        # 各会话元数据在首次发言时加载，之后靠 conv.changed 事件保持最新
+        self.conv_meta = {}
+        self.inbox_group = None
+        self.device_id = self.get_device_id()
+        self.seqs, self.saved_seqs = {}, {}
+        self.pending = defaultdict(set)
+        self.sync_convs = set()
+        await self.validate_user()
+        if getattr(self, 'user', None) is None:
+            await self.close(code=4001)
+            return
+        conv_ids = await self.get_conv_ids()
+        # 一次性并发加入所有房间，避免逐个等待
+        self.conv_ids = set(conv_ids)
+        await asyncio.gather(*(
+            self.channel_layer.group_add(f'chat_{cid}', self.channel_name)
+            for cid in conv_ids
+        ))
+        self.inbox_group = f'user_{self.user_id}'
+        await self.channel_layer.group_add(self.inbox_group, self.channel_name)
+        await self.accept()
+        await presence.touch(self.user_id, self.channel_name)
+        await self.start_sync()
+        now_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f'[WS] {self.user_id} 加入 {len(conv_ids)} 个房间 加入时间 {now_time}')
+
+    # ---------------- 断开 ----------------
+    async def disconnect(self, code):
+        await asyncio.gather(*(
+            self.channel_layer.group_discard(f'chat_{cid}', self.channel_name)
+            for cid in self.conv_ids
+        ))
+        if self.inbox_group:
+            await self.channel_layer.group_discard(self.inbox_group, self.channel_name)
+            await presence.leave(self.user_id, self.channel_name)
+        if self.seqs != self.saved_seqs:
+            await self.save_sync_cursor(self.seqs)
+        now_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f'[WS] {self.channel_name} 断开 离开时间 {now_time}')
+        raise StopConsumer()
+
+    # ---------------- 收到消息 ----------------
+    async def receive(self, text_data=None, bytes_data=None):
+        if text_data == '__ping__':
+            await presence.touch(self.user_id, self.channel_name)
+            await self.send('__pong__')
+            return
+        try:
+            data = json.loads(text_data)
+            if data.get('type') == 'sync':
+                # 补推没拉完：{"type": "sync"}，从服务端记的位置继续
+                conv_id = None
+            else:
+                conv_id = int(data['conv_id'])
+        except Exception:
+            return  # 非法格式 / 缺 conv_id 直接丢弃
+        if conv_id is None:
+            await self.send_sync()
+            return
+        if conv_id not in self.conv_ids:
+            # 连接之后才加入的会话：校验一次后补进房间
+            if not await self.is_participant(conv_id):
+                return
+            await self.join_conv(conv_id)
+        await self.handle_frame(conv_id, data)
+
+    async def chat_message(self, event):
+        await super().chat_message(event)
+        self.note_delivered(event['payload'])
+
+    async def inbox_notify(self, event):
+        conv_id = event['payload'].get('conv_id')
+        if event['state'] == 200 and conv_id is not None:
+            if conv_id in self.conv_ids:
+                # 已经通过房间收到 chat.message，不重复推送
+                return
+            # 新会话的第一条消息：补进房间，后续走房间广播
+            await self.join_conv(conv_id)
+        await super().inbox_notify(event)
 
+    async def conv_changed(self, event):
+        await super().conv_changed(event)
+        conv_id = event['conv_id']
+        if self.user_id in event['removed'] and conv_id in self.conv_ids:
+            await self.leave_conv(conv_id)
+        elif self.user_id in event['added'] and conv_id not in self.conv_ids:
+            await self.join_conv(conv_id)
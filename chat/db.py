@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+# consumer 写库专用线程池：不和默认的 thread_sensitive 单线程抢，
+# 并发写入数随连接数增长，上限为 CHAT_DB_WRITE_WORKERS
+_write_executor = ThreadPoolExecutor(
+    max_workers=settings.CHAT_DB_WRITE_WORKERS,
+    thread_name_prefix='chat-db-write',
+)
+
+
+def db_write(fn):
+    """
+    把同步写库函数放到写库线程池执行，
+    前后清理过期连接（同 channels 的 database_sync_to_async）
+    """
+    @wraps(fn)
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(run, thread_sensitive=False, executor=_write_executor)
+
+
+# 异步 ORM 在 thread_sensitive 线程上执行，清理连接也要在同一线程
+_close_old_connections = sync_to_async(close_old_connections)
+
+
+def db_read(fn):
+    """
+    异步 ORM 读：前后清理过期连接，连接用完归还连接池，
+    MySQL 超时断开或重启后能重连（异步 ORM 本身不做这一步）
+    """
+    @wraps(fn)
+    async def run(*args, **kwargs):
+        await _close_old_connections()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            await _close_old_connections()
+
+    return run
@@ -0,0 +1,69 @@
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import presence
+
+
+async def group_send_batch(channel_layer, sends):
+    """
+    一批 (group, message) 分批并发发送
+    避免 N 个收件箱串行 N 次 Redis 往返
+    """
+    sends = list(sends)
+    batch_size = settings.CHAT_FANOUT_BATCH_SIZE
+    for i in range(0, len(sends), batch_size):
+        batch = sends[i:i + batch_size]
+        results = await asyncio.gather(
+            *(channel_layer.group_send(g, m) for g, m in batch),
+            return_exceptions=True,
+        )
+        for (group, _), res in zip(batch, results):
+            if isinstance(res, Exception):
+                # 单个收件箱失败不影响其他成员
+                print(f'[WS] 投递 {group} 失败:', res)
+
+
+async def group_send_many(channel_layer, groups, message):
+    """同一条消息投递到多个 group"""
+    await group_send_batch(channel_layer, ((g, message) for g in groups))
+
+
+def inbox_groups(user_ids):
+    return [f'user_{uid}' for uid in user_ids]
+
+
+async def publish_inbox(channel_layer, user_ids, payload):
+    """新消息投到成员收件箱，只投在线成员，离线成员上线后自行拉取"""
+    online = await presence.filter_online(user_ids)
+    await group_send_many(
+        channel_layer,
+        inbox_groups(online),
+        {"type": "inbox.notify", "state": 200, "payload": payload}
+    )
+
+
+async def publish_message(channel_layer, conv_id, payload, other_uids):
+    """新消息推送：回播给整个房间，再投到其他成员的收件箱"""
+    await channel_layer.group_send(
+        f'chat_{conv_id}',
+        {"type": "chat.message", "state": 200, "payload": payload}
+    )
+    await publish_inbox(channel_layer, other_uids, payload)
+
+
+def notify_conv_changed(conv_id, added=(), removed=()):
+    """
+    成员变动后通知在线连接更新缓存的成员集合（在同步视图里调用）
+    新成员的收件箱也通知一份，多路复用连接据此加入房间
+    """
+    event = {
+        "type": "conv.changed",
+        "conv_id": conv_id,
+        "added": list(added),
+        "removed": list(removed),
+    }
+    groups = [f'chat_{conv_id}'] + inbox_groups(added)
+    async_to_sync(group_send_many)(get_channel_layer(), groups, event)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat.services import backfill_friendships
+
+
+class Command(BaseCommand):
+    help = '按已接受的 FriendRequest 回填 Friendship 好友邻接表（迁移 0008 已回填一次，用于修复数据）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = backfill_friendships(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'已回填 {total} 对好友关系'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import ConversationParticipant
+from chat.services import count_unread
+
+
+class Command(BaseCommand):
+    help = '按 Message 表和已读水位重算 ConversationParticipant.unread_count'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conv', type=int, nargs='*', help='只校正指定会话 id')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        qs = ConversationParticipant.objects.order_by('id')
+        if options['conv']:
+            qs = qs.filter(conversation_id__in=options['conv'])
+        batch_size = options['batch_size']
+
+        fixed = 0
+        batch = []
+        for p in qs.iterator(chunk_size=batch_size):
+            # 水位之后、别人发的消息
+            unread = count_unread(p.conversation_id, p.user_id, p.read_up_to_msg_id)
+            if unread != p.unread_count:
+                p.unread_count = unread
+                batch.append(p)
+            if len(batch) >= batch_size:
+                ConversationParticipant.objects.bulk_update(batch, ['unread_count'])
+                fixed += len(batch)
+                batch = []
+        if batch:
+            ConversationParticipant.objects.bulk_update(batch, ['unread_count'])
+            fixed += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'已校正 {fixed} 条未读计数'))
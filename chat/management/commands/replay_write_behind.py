@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import writebehind
+from chat.redis_client import get_client
+
+
+class Command(BaseCommand):
+    help = '延迟写入：拿到写入锁后重写没写完的那批，并把 Redis 日志里剩余的消息全部落库'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-drain', action='store_true', help='只重写处理中列表，不清空日志')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_WRITE_BEHIND_BATCH)
+        parser.add_argument(
+            '--wait', type=int, default=writebehind.LOCK_TTL_MS // 1000 + 5,
+            help='等写入锁的秒数：上一个持锁进程退出后，锁要过期才能拿到'
+        )
+
+    def handle(self, *args, **options):
+        client = get_client()
+        token = writebehind.writer_token()
+        deadline = time.monotonic() + options['wait']
+        while not writebehind.acquire(client, token):
+            if time.monotonic() > deadline:
+                raise CommandError('写入锁被占用：有写入线程正在运行，由它落库即可')
+            time.sleep(1)
+
+        try:
+            replayed = writebehind.flush_once(client, token, 0)
+            drained = 0
+            if not options['no_drain']:
+                while True:
+                    n = writebehind.flush_once(client, token, options['batch_size'])
+                    if not n:
+                        break
+                    drained += n
+        finally:
+            writebehind.release(client, token)
+        self.stdout.write(self.style.SUCCESS(
+            f'重写处理中批次 {replayed or 0} 条，日志落库 {drained} 条'
+        ))
+        conflicts = client.llen(writebehind.CONFLICTS_KEY)
+        if conflicts:
+            self.stdout.write(self.style.ERROR(
+                f'{writebehind.CONFLICTS_KEY} 里有 {conflicts} 条冲突消息未落库，需人工处理'
+            ))
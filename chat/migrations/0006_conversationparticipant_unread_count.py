@@ -0,0 +1,51 @@
+# Generated by Django 4.2 on 2026-10-18 13:58
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill(apps, schema_editor):
+    # 已有成员的未读数按已读水位回填，否则上线后会话列表全是 0；逻辑同 recount_unread
+    ConversationParticipant = apps.get_model('chat', 'ConversationParticipant')
+    Message = apps.get_model('chat', 'Message')
+    batch_size = 1000
+
+    def unread_sq(after_watermark):
+        qs = Message.objects.filter(
+            conversation_id=OuterRef('conversation_id')
+        ).exclude(sender_id=OuterRef('user_id'))
+        if after_watermark:
+            qs = qs.filter(id__gt=OuterRef('read_up_to_msg_id'))
+        return Coalesce(Subquery(
+            qs.order_by().values('conversation_id').annotate(n=Count('id')).values('n')[:1]
+        ), 0)
+
+    last_id = 0
+    while True:
+        ids = list(
+            ConversationParticipant.objects.filter(id__gt=last_id)
+            .order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        batch = ConversationParticipant.objects.filter(id__in=ids)
+        batch.filter(read_up_to_msg_id__isnull=True).update(unread_count=unread_sq(False))
+        batch.filter(read_up_to_msg_id__isnull=False).update(unread_count=unread_sq(True))
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_remove_friendrequest_chat_no_self_friend_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationparticipant',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
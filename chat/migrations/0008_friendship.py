@@ -0,0 +1,58 @@
+# Generated by Django 4.2 on 2026-10-18 14:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill(apps, schema_editor):
+    # 已有好友关系来自已接受的好友请求，建表后立即回填，否则好友列表为空
+    # 与 services.backfill_friendships 相同，但只用历史模型，不随应用代码变化
+    FriendRequest = apps.get_model('chat', 'FriendRequest')
+    Friendship = apps.get_model('chat', 'Friendship')
+    User = apps.get_model('user', 'User')
+    batch_size = 1000
+
+    user_ids = set(User.objects.values_list('user_id', flat=True))
+    pairs = (
+        FriendRequest.objects
+        .filter(status='accepted')
+        .order_by('id')
+        .values_list('from_user_id', 'to_user_id')
+    )
+    batch = []
+    for from_id, to_id in pairs.iterator(chunk_size=batch_size):
+        # 请求表只存 user_id，已注销的用户跳过
+        if from_id not in user_ids or to_id not in user_ids:
+            continue
+        batch.append(Friendship(user_id=from_id, friend_id=to_id))
+        batch.append(Friendship(user_id=to_id, friend_id=from_id))
+        if len(batch) >= batch_size:
+            Friendship.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    if batch:
+        Friendship.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0027_alter_conversationparticipant_unique_together_and_more'),
+        ('chat', '0007_message_conv_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Friendship',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('friend', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='user.user')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friendships', to='user.user')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='friendship',
+            constraint=models.UniqueConstraint(fields=('user', 'friend'), name='chat_uniq_friendship'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
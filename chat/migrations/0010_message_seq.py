@@ -0,0 +1,60 @@
+# Generated by Django 4.2 on 2026-10-18 14:30
+
+from django.db import migrations, models
+
+
+def backfill_seq(apps, schema_editor):
+    """历史消息按 id 顺序在各自会话内编号 1..n，并写回会话的 last_seq"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+    batch_size = 1000
+
+    conv_ids = Message.objects.values_list('conversation_id', flat=True).distinct()
+    for conv_id in list(conv_ids):
+        seq = 0
+        last_id = 0
+        while True:
+            batch = list(
+                Message.objects
+                .filter(conversation_id=conv_id, id__gt=last_id)
+                .order_by('id')
+                .only('id')[:batch_size]
+            )
+            if not batch:
+                break
+            for m in batch:
+                seq += 1
+                m.seq = seq
+            Message.objects.bulk_update(batch, ['seq'])
+            last_id = batch[-1].id
+        Conversation.objects.filter(pk=conv_id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_synccursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('conversation', 'seq'), name='chat_uniq_conv_seq'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# 旧游标是按用户的全局消息 id，换成按设备、按会话的 seq，无法换算，直接重建
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0028_user_created_at_updated_at_idx'),
+        ('chat', '0012_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='SyncCursor',
+        ),
+        migrations.CreateModel(
+            name='SyncCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.CharField(blank=True, default='', max_length=64)),
+                ('seqs', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_cursors', to='user.user')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'device_id'), name='chat_uniq_sync_cursor')],
+            },
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from django.db.models import Q, F, CheckConstraint, UniqueConstraint, Index
 from django.core.validators import MaxLengthValidator
+from django.utils import timezone
 from django.forms import ValidationError
 from django.db.models import Func, IntegerField, Value
 from user.models import User
@@ -71,6 +72,8 @@ class Conversation(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
     is_dissolved = models.BooleanField(default=False, verbose_name='已解散')
+    # 会话内最后分配的消息序号，发消息时在事务里 +1（只锁本会话这一行）
+    last_seq = models.PositiveBigIntegerField(default=0)
     class Meta:
         constraints = [
             CheckConstraint(
@@ -113,6 +116,8 @@ class ConversationParticipant(models.Model):
     )
     joined_at = models.DateTimeField(auto_now_add=True)
     read_up_to_msg_id = models.PositiveBigIntegerField(null=True, blank=True)
+    # 未读数冗余计数：发消息时 +1，标记已读时 -1，可用 recount_unread 命令校正
+    unread_count = models.PositiveIntegerField(default=0)
 
     class Meta:
         constraints = [
@@ -131,7 +136,8 @@ class Message(models.Model):
         related_name="sent_messages"
     )
     content = models.TextField(validators=[MaxLengthValidator(20000)])
-    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+    # 不用 auto_now_add：延迟写入时要保留发送时刻，bulk_create 不能覆盖
+    timestamp = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
     is_recalled = models.BooleanField(default=False)
     recalled_at = models.DateTimeField(null=True, blank=True)
     recall_by = models.ForeignKey(
@@ -142,12 +148,24 @@ class Message(models.Model):
         "self", on_delete=models.SET_NULL,
         null=True, blank=True, related_name="replies"
     )
+    # 会话内从 1 开始连续递增的序号，客户端据此排序、去重、发现缺口
+    seq = models.PositiveBigIntegerField()
+    # 客户端生成的消息 id（可选），重发时据此去重
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True)
 
     class Meta:
         ordering = ["timestamp"]
+        constraints = [
+            UniqueConstraint(fields=["conversation", "seq"], name="chat_uniq_conv_seq"),
+            UniqueConstraint(
+                fields=["sender", "conversation", "client_msg_id"],
+                name="chat_uniq_client_msg",
+            ),
+        ]
         indexes = [
             Index(fields=["conversation", "timestamp"]),
-            # FIX: 倒序拉最新消息可复用，或单独再建
+            # 按 (会话, id) 键集分页，前后翻页都走这一个索引
+            Index(fields=["conversation", "id"], name="chat_msg_conv_id_idx"),
         ]
 
 
@@ -168,3 +186,43 @@ class MessageRead(models.Model):
             UniqueConstraint(fields=["user", "message"], name="uniq_read")
         ]
 
+
+# ---------- 6. 好友关系（邻接表） ----------
+class Friendship(models.Model):
+    """
+    每对好友存两行 (user, friend) 和 (friend, user)，按 user 单索引范围扫描
+    由 handle_friend_request / del_friend_or_quit_group 在事务里维护，
+    历史数据用 backfill_friendships 命令回填
+    """
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE,
+        related_name="friendships"
+    )
+    friend = models.ForeignKey(
+        User, on_delete=models.CASCADE,
+        related_name="+"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=["user", "friend"], name="chat_uniq_friendship")
+        ]
+
+
+# ---------- 7. 离线同步游标 ----------
+class SyncCursor(models.Model):
+    """
+    每个设备在各会话里已投递到的 seq：{"<conv_id>": seq}
+    只在连续投递时前进，断开连接时合并保存，重连时 UserConsumer 从这里补推漏掉的消息
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sync_cursors")
+    # 客户端连接时带 ?device=，不带的共用空串
+    device_id = models.CharField(max_length=64, default="", blank=True)
+    seqs = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=["user", "device_id"], name="chat_uniq_sync_cursor")
+        ]
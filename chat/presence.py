@@ -0,0 +1,96 @@
+"""
+在线状态：Redis 里记录每个用户当前的 ws 连接
+presence:u:<uid>  hash  channel_name -> "node_id|时间戳"，整键 TTL，由 __ping__ 心跳续期
+presence:last_seen hash  uid -> 最后活跃时间戳
+Redis 不可用时按全部在线处理（fail-open），只影响投递优化，不影响收发
+"""
+import time
+
+from django.conf import settings
+
+from .redis_client import get_async_client
+
+LAST_SEEN_KEY = 'presence:last_seen'
+# Redis 出错后暂停访问的秒数，避免每次收发都卡在连接超时上
+RETRY_AFTER = 5
+
+_down_until = 0.0
+
+
+def _key(user_id):
+    return f'presence:u:{user_id}'
+
+
+def _available() -> bool:
+    return settings.PRESENCE_ENABLED and time.monotonic() >= _down_until
+
+
+def _mark_down(action, e):
+    global _down_until
+    _down_until = time.monotonic() + RETRY_AFTER
+    print(f'[presence] {action}失败，{RETRY_AFTER}s 内跳过:', e)
+
+
+async def touch(user_id, channel_name):
+    """连接建立 / 心跳：登记本连接并续期"""
+    if not _available():
+        return
+    now = int(time.time())
+    try:
+        async with get_async_client().pipeline(transaction=False) as pipe:
+            pipe.hset(_key(user_id), channel_name, f'{settings.NODE_ID}|{now}')
+            pipe.expire(_key(user_id), settings.PRESENCE_TTL)
+            pipe.hset(LAST_SEEN_KEY, user_id, now)
+            await pipe.execute()
+    except Exception as e:
+        _mark_down('更新', e)
+
+
+async def leave(user_id, channel_name):
+    """连接断开：注销本连接，记录最后活跃时间"""
+    if not _available():
+        return
+    try:
+        async with get_async_client().pipeline(transaction=False) as pipe:
+            pipe.hdel(_key(user_id), channel_name)
+            pipe.hset(LAST_SEEN_KEY, user_id, int(time.time()))
+            await pipe.execute()
+    except Exception as e:
+        _mark_down('注销', e)
+
+
+async def filter_online(user_ids) -> list:
+    """只保留在线用户，一次管道往返；出错时原样返回"""
+    user_ids = list(user_ids)
+    if not user_ids or not _available():
+        return user_ids
+    try:
+        async with get_async_client().pipeline(transaction=False) as pipe:
+            for uid in user_ids:
+                pipe.exists(_key(uid))
+            flags = await pipe.execute()
+    except Exception as e:
+        _mark_down('查询', e)
+        return user_ids
+    return [uid for uid, on in zip(user_ids, flags) if on]
+
+
+async def lookup(user_ids) -> dict:
+    """批量查询在线状态：{uid: {online, last_seen}}，节点名属内部信息不返回"""
+    user_ids = list(user_ids)
+    async with get_async_client().pipeline(transaction=False) as pipe:
+        for uid in user_ids:
+            pipe.hvals(_key(uid))
+        pipe.hmget(LAST_SEEN_KEY, user_ids)
+        *conns, last_seen = await pipe.execute()
+
+    # 节点崩溃时它名下的连接不会被 HDEL，按心跳时间剔除
+    deadline = time.time() - settings.PRESENCE_TTL
+    result = {}
+    for uid, vals, seen in zip(user_ids, conns, last_seen):
+        online = any(int(v.rpartition('|')[2]) >= deadline for v in vals)
+        result[uid] = {
+            'online': online,
+            'last_seen': int(seen) if seen else None,
+        }
+    return result
@@ -0,0 +1,42 @@
+"""
+聊天模块共用的 Redis 客户端（与 channel layer 同一个 Redis）
+"""
+import asyncio
+import threading
+import weakref
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+# redis.asyncio 的连接绑定事件循环，按循环各建一个客户端
+_async_clients = weakref.WeakKeyDictionary()
+_sync_client = None
+_sync_lock = threading.Lock()
+
+
+def _options():
+    return dict(
+        host=settings.CHANNEL_LAYER_REDIS_HOST,
+        port=settings.CHANNEL_LAYER_REDIS_PORT,
+        decode_responses=True,
+        socket_connect_timeout=1,
+        socket_timeout=1,
+    )
+
+
+def get_async_client() -> aioredis.Redis:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = aioredis.Redis(**_options())
+    return client
+
+
+def get_client() -> redis.Redis:
+    """同步客户端，自带连接池，进程内各线程共用"""
+    global _sync_client
+    with _sync_lock:
+        if _sync_client is None:
+            _sync_client = redis.Redis(**_options())
+        return _sync_client
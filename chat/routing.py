@@ -3,5 +3,7 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
+    # 多路复用：一个用户一条连接，帧内带 conv_id
+    re_path(r'chat/channel/$', consumers.UserConsumer.as_asgi()),
     re_path(r'chat/channel/(?P<conv_id>\w+)/$', consumers.ChatConsumer.as_asgi()),
 ]
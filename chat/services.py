@@ -0,0 +1,392 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Max, Q, Value, When
+from django.utils import timezone
+
+from .db import db_read
+from .models import Conversation, ConversationParticipant, FriendRequest, Friendship, Message, MessageRead, SyncCursor
+from user.models import User
+
+
+class SendForbidden(Exception):
+    """发送方无权在该会话发言"""
+
+
+def message_payload(msg: Message, sender, conv_id) -> dict:
+    # 新消息还没有任何人读过，已读字段直接给初始值，无需查表
+    return {
+        "id": msg.id,
+        "seq": msg.seq,
+        "client_msg_id": msg.client_msg_id,
+        "conv_id": conv_id,
+        "sender_id": sender.user_id,
+        "sender_username": sender.username,
+        "parent_id": msg.parent_message_id,
+        "content": msg.content,
+        "timestamp": msg.timestamp.isoformat(),
+        "is_recalled": msg.is_recalled,
+        "is_read": False,
+        "is_read_by_other": False,
+        "read_count": 0,
+        "readers": [],
+    }
+
+
+def bump_unread(conv_id, sender_id, msg_ids):
+    """
+    新消息：除发送者外的成员未读数加上 msg_ids 里排在其已读水位之后的条数
+    水位已经越过的消息（延迟写入时先读后落库）不再计入，与 count_unread 一致
+    """
+    msg_ids = sorted(msg_ids)
+    n = len(msg_ids)
+    # 水位落在第 i 条之前，则第 i 条及之后的 n - i 条未读
+    added = Case(
+        When(read_up_to_msg_id__isnull=True, then=Value(n)),
+        *(When(read_up_to_msg_id__lt=msg_id, then=Value(n - i)) for i, msg_id in enumerate(msg_ids)),
+        default=Value(0),
+    )
+    ConversationParticipant.objects.filter(
+        Q(read_up_to_msg_id__isnull=True) | Q(read_up_to_msg_id__lt=msg_ids[-1]),
+        conversation_id=conv_id,
+    ).exclude(user_id=sender_id).update(unread_count=F('unread_count') + added)
+
+
+def clean_client_msg_id(value):
+    """客户端消息 id：可选，非空字符串且不超过 64 字符，否则 ValueError"""
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str) or len(value) > 64:
+        raise ValueError('client_msg_id 非法')
+    return value
+
+
+def next_seq(conv_id) -> int:
+    """
+    分配会话内下一个序号，须在事务内调用：
+    UPDATE 锁住该会话这一行直到提交，同会话并发发送排队，不同会话互不影响
+    """
+    updated = Conversation.objects.filter(pk=conv_id).update(last_seq=F('last_seq') + 1)
+    if not updated:
+        raise Conversation.DoesNotExist
+    return Conversation.objects.filter(pk=conv_id).values_list('last_seq', flat=True).get()
+
+
+def load_conv_meta(conv_id) -> dict:
+    """会话元数据：类型、私聊成员、参与者集合，供连接内缓存"""
+    conv = Conversation.objects.only('type', 'private_members').get(pk=conv_id)
+    return {
+        'type': conv.type,
+        'private_members': conv.private_members,
+        'member_ids': set(
+            ConversationParticipant.objects
+            .filter(conversation_id=conv_id)
+            .values_list('user_id', flat=True)
+        ),
+    }
+
+
+@db_read
+async def aload_conv_meta(conv_id) -> dict:
+    """load_conv_meta 的异步版本，consumer 直接 await，不占写库线程"""
+    conv = await Conversation.objects.only('type', 'private_members').aget(pk=conv_id)
+    return {
+        'type': conv.type,
+        'private_members': conv.private_members,
+        'member_ids': {
+            uid async for uid in
+            ConversationParticipant.objects
+            .filter(conversation_id=conv_id)
+            .values_list('user_id', flat=True)
+        },
+    }
+
+
+def check_can_send(meta, sender_id):
+    member_ids = meta['member_ids']
+    if sender_id not in member_ids:
+        raise SendForbidden('您不在该会话中')
+    # 私聊：双方都还在 participants 里才能发
+    if meta['type'] == Conversation.PRIVATE and not set(meta['private_members']) <= member_ids:
+        raise SendForbidden('对方已解除好友，无法发送消息')
+
+
+def send_message(conv_id, sender, content, parent_id=None, meta=None, client_msg_id=None):
+    """
+    发送链路：校验成员 -> 落库 -> 组装推送数据，一次完成
+    meta 为空时现查会话和成员（2 条 SQL），连接内已缓存则鉴权不再读库
+    其余 4 条 SQL：分配序号（2 条）、插入、未读数 +1；
+    带父消息、client_msg_id 时各多 1 条查询，条数由 chat/tests.py 固定
+    带 client_msg_id 的重发直接返回已有消息，不再插入、不加未读
+    返回 (meta, payload, 其他成员 user_id 列表, 是否新插入)
+    """
+    if meta is None:
+        meta = load_conv_meta(conv_id)
+    check_can_send(meta, sender.user_id)
+    other_uids = [uid for uid in meta['member_ids'] if uid != sender.user_id]
+
+    if client_msg_id:
+        existing = _find_client_msg(conv_id, sender, client_msg_id)
+        if existing:
+            return meta, message_payload(existing, sender, conv_id), other_uids, False
+
+    if parent_id:
+        parent_id = Message.objects.filter(pk=parent_id).values_list('id', flat=True).first()
+    try:
+        with transaction.atomic():
+            msg = Message.objects.create(
+                conversation_id=conv_id,
+                seq=next_seq(conv_id),
+                sender=sender,
+                content=content,
+                parent_message_id=parent_id or None,
+                client_msg_id=client_msg_id,
+            )
+            bump_unread(conv_id, sender.user_id, [msg.id])
+    except IntegrityError:
+        # 并发重发：另一条已先插入成功，序号和未读数随本事务一起回滚
+        existing = client_msg_id and _find_client_msg(conv_id, sender, client_msg_id)
+        if not existing:
+            raise
+        return meta, message_payload(existing, sender, conv_id), other_uids, False
+    return meta, message_payload(msg, sender, conv_id), other_uids, True
+
+
+def _find_client_msg(conv_id, sender, client_msg_id):
+    return Message.objects.filter(
+        sender=sender, conversation_id=conv_id, client_msg_id=client_msg_id
+    ).first()
+
+
+@db_read
+async def aload_sync_cursor(user_id, device_id):
+    """设备上次保存的各会话 seq，{conv_id: seq}；从没保存过返回 None"""
+    seqs = await SyncCursor.objects.filter(
+        user_id=user_id, device_id=device_id
+    ).values_list('seqs', flat=True).afirst()
+    if seqs is None:
+        return None
+    return {int(conv_id): seq for conv_id, seq in seqs.items()}
+
+
+@db_read
+async def alast_seqs(conv_ids) -> dict:
+    """这些会话当前的 last_seq"""
+    return {
+        conv_id: last_seq async for conv_id, last_seq in
+        Conversation.objects.filter(id__in=conv_ids).values_list('id', 'last_seq')
+    }
+
+
+@db_read
+async def amissed_messages(cursors, limit):
+    """
+    断线期间漏掉的消息：cursors 为 {conv_id: 已投递 seq}，多个会话按 id 合并，一次取 limit 条
+    同一会话 id 与 seq 同序且按序提交（直接写入靠会话行锁，延迟写入靠单个持锁写入者），
+    所以每页都是各会话缺口的连续前缀
+    返回 (payload 列表, 是否还有更多)
+    """
+    if not cursors:
+        return [], False
+    cond = Q()
+    for conv_id, seq in cursors.items():
+        cond |= Q(conversation_id=conv_id, seq__gt=seq)
+    qs = (
+        Message.objects
+        .filter(cond)
+        .select_related('sender')
+        .order_by('id')[:limit + 1]
+    )
+    rows = [m async for m in qs]
+    return [message_payload(m, m.sender, m.conversation_id) for m in rows[:limit]], len(rows) > limit
+
+
+def save_sync_cursor(user_id, device_id, seqs):
+    """
+    按会话合并保存，每个会话只前进不后退；
+    只保留本次传入的会话，已退出的会话随之清掉
+    """
+    with transaction.atomic():
+        cursor, _ = SyncCursor.objects.select_for_update().get_or_create(
+            user_id=user_id, device_id=device_id
+        )
+        old = cursor.seqs
+        cursor.seqs = {
+            str(conv_id): max(seq, old.get(str(conv_id), 0))
+            for conv_id, seq in seqs.items()
+        }
+        cursor.save(update_fields=['seqs', 'updated_at'])
+
+
+def count_unread(conv_id, user_id, read_up_to=None):
+    """水位之后、别人发的消息数"""
+    qs = Message.objects.filter(conversation_id=conv_id).exclude(sender_id=user_id)
+    if read_up_to:
+        qs = qs.filter(id__gt=read_up_to)
+    return qs.count()
+
+
+def advance_read(conv_id, user, up_to_msg_id):
+    """
+    已读水位前移到 up_to_msg_id 之前别人发的最后一条（只进不退，防止乱序），
+    水位之前的消息都视为已读，并按新水位重算未读数，整体一个事务
+    开启 CHAT_READ_DETAIL_LOG 时额外写 MessageRead 明细
+    返回 (participant, {sender_id: 本次读到的该发送者最后一条消息 id})
+    不在会话中抛 ConversationParticipant.DoesNotExist
+    """
+    with transaction.atomic():
+        participant = ConversationParticipant.objects.select_for_update().get(
+            conversation_id=conv_id, user=user
+        )
+        old = participant.read_up_to_msg_id or 0
+        if up_to_msg_id <= old:
+            return participant, {}
+        newly_read = Message.objects.filter(
+            conversation_id=conv_id, id__gt=old, id__lte=up_to_msg_id
+        ).exclude(sender_id=user.user_id)
+        receipts = dict(
+            newly_read.order_by()
+            .values('sender_id')
+            .annotate(last_id=Max('id'))
+            .values_list('sender_id', 'last_id')
+        )
+        if not receipts:
+            return participant, {}
+        # 水位只落在真实存在的消息上，避免客户端传超大 id 把以后的消息也算成已读
+        participant.read_up_to_msg_id = max(receipts.values())
+        participant.unread_count = count_unread(conv_id, user.user_id, participant.read_up_to_msg_id)
+        participant.save(update_fields=['read_up_to_msg_id', 'unread_count'])
+        if settings.CHAT_READ_DETAIL_LOG:
+            now = timezone.now()
+            MessageRead.objects.bulk_create([
+                MessageRead(user=user, message_id=mid, read_at=now)
+                for mid in newly_read.values_list('id', flat=True)
+            ], ignore_conflicts=True)
+    return participant, receipts
+
+
+def read_receipts(conv_id, user, participant, receipts):
+    """每个发送者一条合并后的已读回执 [(group, event)]"""
+    read_at = timezone.now().isoformat()
+    return [
+        (f'user_{sender_id}', {
+            "type": "msg.read",
+            "state": 200,
+            "data": {
+                "msg_id": last_id,
+                "up_to_msg_id": participant.read_up_to_msg_id,
+                "conv_id": conv_id,
+                "reader_id": user.user_id,
+                "reader_name": user.username,
+                "read_at": read_at,
+            },
+        })
+        for sender_id, last_id in receipts.items()
+    ]
+
+
+def read_state(participants, msg, me, mate_uid=None):
+    """
+    按参与者水位推算一条消息的已读信息
+    participants: [{'user_id', 'user__username', 'read_up_to_msg_id'}]，按水位降序
+    """
+    def has_read(p):
+        return p['user_id'] != msg.sender_id and (p['read_up_to_msg_id'] or 0) >= msg.id
+
+    info = {
+        'is_read': False,
+        'is_read_by_other': False,
+        'read_count': 0,
+        'readers': [],
+    }
+    for p in participants:
+        if (p['read_up_to_msg_id'] or 0) < msg.id:
+            break  # 已按水位降序，后面都没读到这条
+        if not has_read(p):
+            continue
+        if p['user_id'] == me:
+            info['is_read'] = True
+        if mate_uid is None:
+            info['readers'].append({
+                'user_id': p['user_id'],
+                'username': p['user__username'],
+            })
+        elif p['user_id'] == mate_uid:
+            info['is_read_by_other'] = True
+    info['read_count'] = len(info['readers'])
+    return info
+
+
+def make_friends(uid1, uid2):
+    """写入双向好友关系（需在调用方事务内）"""
+    Friendship.objects.bulk_create([
+        Friendship(user_id=uid1, friend_id=uid2),
+        Friendship(user_id=uid2, friend_id=uid1),
+    ], ignore_conflicts=True)
+
+
+def visible_user_ids(user_id, user_ids) -> set:
+    """user_ids 里 user_id 可以查看在线状态的人：自己、好友、同会话成员"""
+    visible = set(
+        Friendship.objects
+        .filter(user_id=user_id, friend_id__in=user_ids)
+        .values_list('friend_id', flat=True)
+    )
+    visible |= set(
+        ConversationParticipant.objects
+        .filter(
+            user_id__in=set(user_ids) - visible,
+            conversation__participants__user_id=user_id,
+        )
+        .values_list('user_id', flat=True)
+    )
+    if user_id in user_ids:
+        visible.add(user_id)
+    return visible
+
+
+def backfill_friendships(batch_size=1000):
+    """
+    按已接受的好友请求回填双向好友关系，可重复执行；返回回填的好友对数
+    迁移 0008 里有一份同样的循环（迁移只能用历史模型），改这里时不用同步改迁移
+    """
+    user_ids = set(User.objects.values_list('user_id', flat=True))
+    pairs = (
+        FriendRequest.objects
+        .filter(status='accepted')
+        .order_by('id')
+        .values_list('from_user_id', 'to_user_id')
+    )
+    total = 0
+    batch = []
+    for from_id, to_id in pairs.iterator(chunk_size=batch_size):
+        # 请求表只存 user_id，已注销的用户跳过
+        if from_id not in user_ids or to_id not in user_ids:
+            continue
+        batch.append(Friendship(user_id=from_id, friend_id=to_id))
+        batch.append(Friendship(user_id=to_id, friend_id=from_id))
+        if len(batch) >= batch_size:
+            Friendship.objects.bulk_create(batch, ignore_conflicts=True)
+            total += len(batch)
+            batch = []
+    if batch:
+        Friendship.objects.bulk_create(batch, ignore_conflicts=True)
+        total += len(batch)
+    return total // 2
+
+
+def unfriend(uid1, uid2):
+    Friendship.objects.filter(
+        Q(user_id=uid1, friend_id=uid2) | Q(user_id=uid2, friend_id=uid1)
+    ).delete()
+
+
+def are_friends(uid1, uid2) -> bool:
+    return Friendship.objects.filter(user_id=uid1, friend_id=uid2).exists()
+
+
+def mutual_friend_ids(uid1, uid2) -> list[int]:
+    return list(
+        Friendship.objects
+        .filter(user_id=uid1, friend_id__in=Friendship.objects.filter(user_id=uid2).values('friend_id'))
+        .values_list('friend_id', flat=True)
+    )
@@ -1,3 +1,159 @@
+import json
+from unittest import mock, skipIf
+
+from asgiref.sync import async_to_sync
 from django.test import TestCase
 
-# Create your tests here.
+from . import services, writebehind
+from .models import Conversation, ConversationParticipant, Message
+from user.models import Role, User
+
+try:
+    import fakeredis
+except ImportError:
+    # 发送脚本的用例需要 fakeredis[lua]，没装时跳过
+    fakeredis = None
+
+
+class GroupChatTestCase(TestCase):
+    """两人群聊：a 发、b 收"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Role.objects.create(role_id=5, role_name='普通用户')
+        cls.a = User.objects.create(username='a', mobile='13800000001')
+        cls.b = User.objects.create(username='b', mobile='13800000002')
+        cls.conv = Conversation.objects.create(type=Conversation.GROUP, name='g', creator=cls.a)
+        for u in (cls.a, cls.b):
+            ConversationParticipant.objects.create(user=u, conversation=cls.conv)
+
+    def unread(self):
+        return ConversationParticipant.objects.get(user=self.b, conversation=self.conv).unread_count
+
+
+class SendMessageQueryCountTests(GroupChatTestCase):
+    """
+    发送链路的 SQL 条数。TestCase 外层包着事务，
+    send_message 里的 atomic 会多出 SAVEPOINT / RELEASE 两条，线上少 2 条
+    """
+
+    def test_cold_send(self):
+        # 会话 + 成员 2 条，分配序号 2 条，插入，未读数 +1，外加 savepoint 2 条
+        with self.assertNumQueries(8):
+            _, payload, other_uids, created = services.send_message(self.conv.id, self.a, 'hi')
+        self.assertTrue(created)
+        self.assertEqual(other_uids, [self.b.user_id])
+        self.assertEqual(payload['seq'], 1)
+
+    def test_warm_send(self):
+        meta = services.load_conv_meta(self.conv.id)
+        # 连接内已缓存元数据，不再查会话和成员
+        with self.assertNumQueries(6):
+            services.send_message(self.conv.id, self.a, 'hi', meta=meta)
+        self.assertEqual(self.unread(), 1)
+
+    def test_count_does_not_grow_with_history(self):
+        meta = services.load_conv_meta(self.conv.id)
+        for i in range(20):
+            services.send_message(self.conv.id, self.b, f'm{i}', meta=meta)
+        with self.assertNumQueries(6):
+            services.send_message(self.conv.id, self.a, 'hi', meta=meta)
+        self.assertEqual(Message.objects.filter(conversation=self.conv).count(), 21)
+
+
+class WriteBehindBatchTests(GroupChatTestCase):
+    """延迟写入落库：重放不重复写，与库里别的消息冲突的条目不写、不加未读"""
+
+    def entry(self, msg_id, seq, content='hi', client_msg_id=None):
+        return {
+            'id': msg_id, 'seq': seq, 'conv_id': self.conv.id, 'sender_id': self.a.user_id,
+            'content': content, 'parent_id': None, 'client_msg_id': client_msg_id,
+            'ts': '2026-01-01T00:00:00+00:00',
+        }
+
+    def test_replay_is_idempotent(self):
+        batch = [self.entry(1000, 1), self.entry(1001, 2)]
+        self.assertEqual(writebehind.write_batch(batch), (2, []))
+        self.assertEqual(writebehind.write_batch(batch), (0, []))
+        self.assertEqual(self.unread(), 2)
+
+    def test_conflicts_are_reported_not_swallowed(self):
+        # 库里已有一条直接写入的消息：seq 1，client_msg_id c
+        _, payload, _, _ = services.send_message(self.conv.id, self.a, 'direct', client_msg_id='c')
+        written, conflicts = writebehind.write_batch([
+            self.entry(payload['id'], 2, 'other'),    # id 被占
+            self.entry(2000, 1),                      # seq 被占
+            self.entry(2001, 3, client_msg_id='c'),   # client_msg_id 被占
+            self.entry(2002, 4),
+        ])
+        self.assertEqual(written, 1)
+        self.assertEqual([c['id'] for c in conflicts], [payload['id'], 2000, 2001])
+        self.assertEqual(self.unread(), 2)
+        self.assertEqual(Conversation.objects.get(pk=self.conv.id).last_seq, 4)
+
+    def test_unread_skips_messages_under_watermark(self):
+        # 客户端先读到 1001，这一批才落库：只有 1002 算未读
+        ConversationParticipant.objects.filter(user=self.b).update(read_up_to_msg_id=1001)
+        writebehind.write_batch([self.entry(1000, 1), self.entry(1001, 2), self.entry(1002, 3)])
+        self.assertEqual(self.unread(), 1)
+        self.assertEqual(self.unread(), services.count_unread(self.conv.id, self.b.user_id, 1001))
+
+
+@skipIf(fakeredis is None, '需要 fakeredis[lua]')
+class WriteBehindSendTests(GroupChatTestCase):
+    """延迟写入发送：计数器下限、client_msg_id 去重、父消息校验（ENQUEUE_LUA）"""
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=server, decode_responses=True)
+        for target, value in (
+            ('get_async_client', lambda: fakeredis.FakeAsyncRedis(server=server, decode_responses=True)),
+            ('ensure_writer', lambda: None),
+        ):
+            patcher = mock.patch.object(writebehind, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def send(self, content, **kwargs):
+        return async_to_sync(writebehind.send_message)(self.conv.id, self.a, content, **kwargs)
+
+    def flush(self):
+        entries = self.redis.lrange(writebehind.JOURNAL_KEY, 0, -1)
+        self.redis.delete(writebehind.JOURNAL_KEY)
+        return writebehind.write_batch([json.loads(e) for e in entries])
+
+    def test_counters_raised_to_db(self):
+        # 关闭延迟写入期间直接入库，Redis 里的计数器落后于库
+        _, direct, _, _ = services.send_message(self.conv.id, self.a, 'direct')
+        self.redis.set(writebehind.MSG_ID_KEY, 1)
+        self.redis.set(f'chat:wb:seq:{self.conv.id}', 0)
+        _, payload, _, created = self.send('hi')
+        self.assertTrue(created)
+        self.assertEqual((payload['id'], payload['seq']), (direct['id'] + 1, direct['seq'] + 1))
+        self.assertEqual(self.flush(), (1, []))
+
+    def test_dedupe(self):
+        _, first, _, created = self.send('hi', client_msg_id='c1')
+        _, again, _, resent = self.send('hi', client_msg_id='c1')
+        self.assertEqual((created, resent, again['id']), (True, False, first['id']))
+        self.assertEqual(self.redis.llen(writebehind.JOURNAL_KEY), 1)
+
+        # 去重记录过期后重发：从库里找回，不再分配
+        self.flush()
+        for key in self.redis.scan_iter('chat:wb:cmid:*'):
+            self.redis.delete(key)
+        _, late, _, resent = self.send('hi', client_msg_id='c1')
+        self.assertEqual((resent, late['id']), (False, first['id']))
+        self.assertEqual(self.redis.llen(writebehind.JOURNAL_KEY), 0)
+
+    def test_parent_checked_before_broadcast(self):
+        _, pending, _, _ = self.send('pending')
+        _, reply, _, _ = self.send('reply', parent_id=pending['id'])
+        _, orphan, _, _ = self.send('orphan', parent_id=pending['id'] + 100)
+        self.assertEqual(reply['parent_id'], pending['id'])
+        self.assertIsNone(orphan['parent_id'])
+        self.flush()
+        self.assertEqual(
+            dict(Message.objects.values_list('content', 'parent_message_id')),
+            {'pending': None, 'reply': pending['id'], 'orphan': None},
+        )
@@ -10,6 +10,7 @@ urlpatterns = [
     path('friends/request/list/', views.friend_request_list),
     path('friends/request/handle/', views.handle_friend_request),
     path('friends/', views.friend_list),
+    path('presence/', views.presence_list),
     path('friends/request/del/<int:conv_id>/', views.del_friend_or_quit_group),
     # 会话相关
     path('conversations/group/', views.create_group),
@@ -22,4 +23,5 @@ urlpatterns = [
     path('messages/send/', views.send_message),
     path('messages/', views.list_messages),
     path('messages/mark-read/', views.mark_as_read),
+    path('messages/mark-read/batch/', views.mark_as_read_batch),
 ]
\ No newline at end of file
@@ -1,19 +1,20 @@
 import json
 from typing import List
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse
 from django.views.decorators.http import require_http_methods
+from django.conf import settings
 from django.db import transaction
-from django.db.models import OuterRef, Subquery, Exists, Q
+from django.db.models import OuterRef, Subquery
 
-from .models import Conversation, ConversationParticipant, FriendRequest, Message, MessageRead
+from . import presence, services, writebehind
+from .fanout import group_send_batch, notify_conv_changed, publish_message
+from .models import Conversation, ConversationParticipant, FriendRequest, Friendship, Message
 from user.models import User
-from utils.user import get_user
 from utils.response import success_response, error_response
 from utils.user import get_a_token, get_user
 
 from django.utils import timezone
 from django.utils import timezone as dj_tz
-from django.db import models
 
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
@@ -46,11 +47,7 @@ def send_friend_request(request):
         receiver = User.objects.get(user_id__exact=receiver_id)  # 根据你的用户表结构调整
         if receiver == user:
             return error_response(400, '不能添加自己为好友')
-        if FriendRequest.objects.filter(
-            lesser_id=min(user.user_id, receiver_id),
-            greater_id=max(user.user_id, receiver_id),
-            status=FriendRequest.ACCEPTED
-        ).exists():
+        if services.are_friends(user.user_id, receiver_id):
             return error_response(400, '双方已经是好友')
 
         req_obj, created = FriendRequest.objects.get_or_create(
@@ -76,34 +73,48 @@ def friend_request_list(request):
     if not user:
         return error_response(401, message='用户认证失败')
     direction = request.GET.get("type", "all").strip().lower()
+    status = request.GET.get("status", "").strip().lower()
+    if status and status not in dict(FriendRequest.STATUS_CHOICES):
+        return error_response(400, '状态参数非法')
     try:
-        if direction == "in":
-            qs = FriendRequest.objects.filter(to_user_id=user.user_id)
-        elif direction == "out":
-            qs = FriendRequest.objects.filter(from_user_id=user.user_id)
-        else:  # all
-            qs = FriendRequest.objects.filter(
-                models.Q(from_user_id=user.user_id) | models.Q(to_user_id=user.user_id)
-            )
-        user_ids = set()
-        for fr in qs:
-            user_ids.add(fr.from_user_id)
-            user_ids.add(fr.to_user_id)
-
-        # 3. 一次性把用户记录查出来
-        id2user = {u.pk: u for u in User.objects.filter(pk__in=user_ids)}
+        # 游标分页：last_id 为上一页最后一条请求的 id，按 id 倒序往前翻
+        last_id = int(request.GET.get('last_id', 0))
+        limit = int(request.GET.get('limit', 20))
+    except ValueError:
+        return error_response(400, '分页参数非法')
+    limit = max(1, min(limit, 100))
+    try:
+        def page(**lookup):
+            qs = FriendRequest.objects.filter(**lookup)
+            if status:
+                qs = qs.filter(status=status)
+            if last_id > 0:
+                qs = qs.filter(id__lt=last_id)
+            return list(qs.order_by('-id')[:limit])
+
+        # 收 / 发各走 (to_user_id, status) / (from_user_id, status) 索引，all 时两页合并
+        rows = []
+        if direction in ("in", "all"):
+            rows += page(to_user_id=user.user_id)
+        if direction in ("out", "all"):
+            rows += page(from_user_id=user.user_id)
+        rows = sorted(rows, key=lambda fr: fr.id, reverse=True)[:limit]
+
+        # 3. 一次性把对方用户记录查出来
+        other_ids = [
+            fr.to_user_id if fr.from_user_id == user.user_id else fr.from_user_id
+            for fr in rows
+        ]
+        id2user = User.objects.in_bulk(other_ids)
         data = []
-        for fr in qs:  # 一次性把 from_user 取出
+        for fr, other_id in zip(rows, other_ids):
             # 统一只返回“对方”的信息，方便前端展示
-            if fr.from_user_id == user.user_id:          # 我发出的
-                other_id = fr.to_user_id
-            else:                                         # 别人发给我的
-                other_id = fr.from_user_id
             other = id2user.get(other_id)
             data.append({
+                "id": fr.id,                       # 翻页游标
                 "user_id": other_id,               # 对方 ID
                 "username": other.username if other else "",
-                "avatar": other.avatar if other and other.avatar else None,
+                "avatar": other.avatar.url if other and other.avatar else None,
                 "status": fr.status,               # pending / accepted / declined
                 "created_at": fr.created_at,
                 "direction": "out" if fr.from_user_id == user.user_id else "in",  # 给前端做标记
@@ -138,10 +149,51 @@ def handle_friend_request(request):
         return error_response(404, "请求不存在或已处理")
 
     req_obj.status = FriendRequest.ACCEPTED if action == "accept" else FriendRequest.DECLINED
-    req_obj.save(update_fields=["status", "updated_at"])
+    with transaction.atomic():
+        req_obj.save(update_fields=["status", "updated_at"])
+        if req_obj.status == FriendRequest.ACCEPTED:
+            services.make_friends(req_obj.from_user_id, req_obj.to_user_id)
     return success_response({"status": req_obj.status}, f"已{action}")
 
 
+# 批量查询在线状态 ?user_ids=1,2,3，只返回好友和同会话成员
+PRESENCE_QUERY_MAX = 200
+
+
+def presence_list(request):
+    if request.method != "GET":
+        return error_response(405, "Method not allowed")
+    user = get_user(get_a_token(request))
+    if not user:
+        return error_response(401, message='用户认证失败')
+    if not settings.PRESENCE_ENABLED:
+        return error_response(503, '在线状态服务未开启')
+
+    try:
+        user_ids = list(dict.fromkeys(
+            int(x) for x in request.GET.get('user_ids', '').split(',') if x.strip()
+        ))
+    except ValueError:
+        return error_response(400, 'user_ids 格式错误')
+    if not user_ids or len(user_ids) > PRESENCE_QUERY_MAX:
+        return error_response(400, f'user_ids 数量需在 1~{PRESENCE_QUERY_MAX} 之间')
+
+    visible = services.visible_user_ids(user.user_id, user_ids)
+    user_ids = [uid for uid in user_ids if uid in visible]
+    if not user_ids:
+        return success_response(data=[], message='在线状态获取成功')
+
+    try:
+        status = async_to_sync(presence.lookup)(user_ids)
+    except Exception as e:
+        print('[presence] 查询失败:', e)
+        return error_response(503, '在线状态查询失败')
+    return success_response(
+        data=[{"user_id": uid, **status[uid]} for uid in user_ids],
+        message='在线状态获取成功'
+    )
+
+
 # 获取好友列表
 def friend_list(request):
     if request.method != "GET":
@@ -151,27 +203,18 @@ def friend_list(request):
     if not user:
         return error_response(401, message='用户认证失败')
 
-    uid = user.user_id
-    reqs = FriendRequest.objects.filter(
-        status=FriendRequest.ACCEPTED
-    ).filter(
-        models.Q(from_user_id=uid) | models.Q(to_user_id=uid)
-    )
+    # 好友邻接表按 user 单索引范围扫描，连表一次取出对方资料
+    rows = Friendship.objects.filter(
+        user_id=user.user_id
+    ).select_related('friend').order_by('id')
 
     friends = []
-    for r in reqs:
-        if r.from_user_id == uid:
-            friends.append({
-                "user_id": r.to_user_id,
-                "username": r.to_user.username,
-                'avatar': r.to_user.avatar.url if r.to_user.avatar else None
-                })
-        else:
-            friends.append({
-                "user_id": r.from_user_id,
-                "username": r.from_user.username,
-                'avatar': r.from_user.avatar.url if r.from_user.avatar else None
-                })
+    for r in rows:
+        friends.append({
+            "user_id": r.friend_id,
+            "username": r.friend.username,
+            'avatar': r.friend.avatar.url if r.friend.avatar else None
+            })
     return success_response(
         data=friends,
         message='好友列表获取成功'
@@ -207,10 +250,13 @@ def del_friend_or_quit_group(request, conv_id):
         ).first()
         if not fr:
             return error_response(404, "还不是好友")
-        fr.delete()
-        ConversationParticipant.objects.filter(
-            conversation=conv, user=user
-        ).delete()
+        with transaction.atomic():
+            fr.delete()
+            services.unfriend(user.user_id, other_uid)
+            ConversationParticipant.objects.filter(
+                conversation=conv, user=user
+            ).delete()
+        notify_conv_changed(conv.id, removed=[user.user_id])
         return success_response(message="已解除好友关系")
     elif conv.type == Conversation.GROUP:
         deleted, _ = ConversationParticipant.objects.filter(
@@ -218,6 +264,7 @@ def del_friend_or_quit_group(request, conv_id):
         ).delete()
         if not deleted:
             return error_response(403, "您不在该群组中")
+        notify_conv_changed(conv.id, removed=[user.user_id])
         return success_response(message="已退出群组")
     else:
         return error_response(500, '服务器内部错误')
@@ -266,6 +313,8 @@ def get_or_create_private(request):
         #         ConversationParticipant(user_id=uid, conversation=conv)
         #         for uid in members
         #     ])
+    if missing:
+        notify_conv_changed(conv.id, added=missing)
     return success_response({'conversation_id': conv.id}, '私聊会话已建立')
 
 
@@ -298,6 +347,7 @@ def create_group(request):
             ConversationParticipant(user_id=uid, conversation=conv)
             for uid in member_ids
         ])
+    notify_conv_changed(conv.id, added=member_ids)
 
     return success_response({'conversation_id': conv.id}, '群聊创建成功')
 
@@ -351,6 +401,7 @@ def del_group(request, conv_id):
                 conversation=conv,
                 user=user
             ).delete()
+        notify_conv_changed(conv.id, removed=[user.user_id])
         return success_response(message='群聊已解散')
     except Exception as e:
         return error_response(500, "服务器内部错误")
@@ -364,42 +415,46 @@ def list_conversations(request):
     if not user:
         return error_response(401, '用户认证失败')
 
+    # ---------- 子查询：我的未读数 ----------
+    unread_sq = ConversationParticipant.objects.filter(
+        conversation=OuterRef('pk'), user=user
+    ).values('unread_count')[:1]
+
     # ---------- 子查询：最新消息 ----------
     last_msg_sq = Message.objects.filter(
         conversation=OuterRef('pk')
-    ).order_by('-timestamp')[:1]
+    ).order_by('-id')[:1]
 
     # ---------- 主查询 ----------
     qs = (Conversation.objects
           .filter(participants__user=user)
           .annotate(
               last_msg_id=Subquery(last_msg_sq.values('id')[:1]),
-              last_time=Subquery(last_msg_sq.values('timestamp')[:1])
+              last_time=Subquery(last_msg_sq.values('timestamp')[:1]),
+              unread=Subquery(unread_sq)
           )
           .order_by('-last_time', '-created_at'))
 
+    convs = list(qs)
+
+    # ---------- 私聊对方昵称：一次查完 ----------
+    mate_uids = {
+        c.id: [uid for uid in c.private_members if uid != user.user_id][0]
+        for c in convs if c.type == Conversation.PRIVATE
+    }
+    mate_names = dict(
+        User.objects
+        .filter(user_id__in=set(mate_uids.values()))
+        .values_list('user_id', 'username')
+    )
+
     data = []
-    for c in qs:
-        # 未读数
-        participant = c.participants.get(user=user)
-        last_read_id = participant.read_up_to_msg_id
-        # 精准未读：对方发的、且在 MessageRead 里找不到我
-        unread = Message.objects.filter(
-            conversation=c
-        ).exclude(
-            sender=user
-        ).annotate(
-            i_read=Exists(
-                MessageRead.objects.filter(message=OuterRef('pk'), user=user)
-            )
-        ).filter(i_read=False).count()
+    for c in convs:
         last_msg_dt = c.last_time
         last_msg_ts = last_msg_dt.timestamp() if last_msg_dt else None
-        # 私聊：拼对方昵称 + 头像
+        # 私聊：拼对方昵称
         if c.type == Conversation.PRIVATE:
-            mate_uid = [uid for uid in c.private_members if uid != user.user_id][0]
-            target_user = User.objects.get(user_id=mate_uid)
-            title = f'{target_user.username}'
+            title = f'{mate_names.get(mate_uids[c.id], "")}'
         else:
             title = c.name
 
@@ -407,8 +462,10 @@ def list_conversations(request):
             'id': c.id,
             'type': c.type,
             'title': title,
-            'unread': unread,
+            'unread': c.unread or 0,
             'last_msg_id': c.last_msg_id,
+            # 客户端本地最大 seq 小于它即有缺口，按 after_seq 补拉
+            'last_seq': c.last_seq,
             'last_time': last_msg_ts,
             'created_at': c.created_at.timestamp(),
             'dissolved': c.is_dissolved,
@@ -425,38 +482,58 @@ def send_message(request):
     if not user:
         return error_response(401, message='用户认证失败')
 
-    conversation_id = request.POST.get('conversation_id')
+    try:
+        conversation_id = int(request.POST.get('conversation_id'))
+        # 可选：回复哪条消息
+        parent_id = int(request.POST.get('parent_id') or 0) or None
+    except (TypeError, ValueError):
+        return error_response(400, '参数错误')
     content = request.POST.get('content', '').strip()
 
     if not content:
         return error_response(400, '消息内容不能为空')
+    try:
+        client_msg_id = services.clean_client_msg_id(request.POST.get('client_msg_id'))
+    except ValueError as e:
+        return error_response(400, str(e))
 
+    # 与 ws 走同一条发送链路：校验成员 + 落库 + 未读数
+    if settings.CHAT_WRITE_BEHIND:
+        save = async_to_sync(writebehind.send_message)
+    else:
+        save = services.send_message
     try:
-        conversation = Conversation.objects.get(id=conversation_id)
-        # 验证用户是否在会话中
-        if not conversation.participants.filter(user=user).exists():
-            return JsonResponse({'error': '无权限发送消息'}, status=403)
-
-        message = Message.objects.create(
-            conversation=conversation,
-            sender=user,
-            content=content
+        meta, payload, other_uids, created = save(
+            conversation_id, user, content,
+            parent_id=parent_id,
+            client_msg_id=client_msg_id,
         )
-        # 实时消息推送逻辑（需要结合WebSocket实现）
-        # 这里可以添加消息推送代码
-        return success_response(
-            data={
-                'message_id': message.id,
-                'timestamp': message.timestamp.isoformat()
-            },
-            message='消息发送成功'
-        )
-
     except Conversation.DoesNotExist:
         return error_response(404, '会话不存在')
+    except services.SendForbidden as e:
+        return error_response(403, str(e))
     except Exception as e:
         return error_response(500, '消息发送失败')
 
+    # 推送给在线连接，接收方无需轮询；重发的消息已推送过
+    # 消息已落库，推送失败不能回 500，否则客户端重发会产生重复消息
+    if created:
+        try:
+            async_to_sync(publish_message)(
+                get_channel_layer(), conversation_id, payload, other_uids
+            )
+        except Exception as e:
+            print(f'[HTTP] 消息 {payload["id"]} 推送失败:', e)
+    return success_response(
+        data={
+            'message_id': payload['id'],
+            'seq': payload['seq'],
+            'client_msg_id': payload['client_msg_id'],
+            'timestamp': payload['timestamp']
+        },
+        message='消息发送成功'
+    )
+
 
 # 获取消息列表
 @require_http_methods(["GET"])
@@ -474,77 +551,62 @@ def list_messages(request):
     ).exists():
         return error_response(403, '你不在该会话中')
     try:
+        # last_msg_id：往前翻（更早），after_msg_id：往后翻（更新）
         last_msg_id = int(request.GET.get('last_msg_id', 0))
+        after_msg_id = int(request.GET.get('after_msg_id', 0))
+        # 同样的语义按会话内序号翻页，优先于 id 游标
+        last_seq = int(request.GET.get('last_seq', 0))
+        after_seq = int(request.GET.get('after_seq', 0))
         limit = int(request.GET.get('limit', 20))
     except ValueError:
         return error_response(400, '分页参数非法')
     limit = max(1, min(limit, 50))          # 至少 1 条，最多 50
     
     # ---------- 5. 取消息 ----------
-    # 1. 自己是否已读（接收者视角）
-    read_sq = MessageRead.objects.filter(
-        message=OuterRef('pk'),
-        user=user
+    # 只按单调递增的 seq / id 做键集分页，命中 (conversation, seq) / (conversation, id) 索引，
+    # 时间戳相同也不会漏/重
+    qs = Message.objects.filter(
+        conversation_id=conv_id
+    ).select_related('sender')
+    if after_seq > 0:
+        qs = list(qs.filter(seq__gt=after_seq).order_by('seq')[:limit])
+    elif after_msg_id > 0:
+        qs = list(qs.filter(id__gt=after_msg_id).order_by('id')[:limit])
+    elif last_seq > 0:
+        qs = reversed(list(qs.filter(seq__lt=last_seq).order_by('-seq')[:limit]))
+    else:
+        if last_msg_id > 0:
+            qs = qs.filter(id__lt=last_msg_id)
+        qs = reversed(list(qs.order_by('-id')[:limit]))
+    # ---------- 已读：由各成员的已读水位推算，一次查完 ----------
+    participants = list(
+        ConversationParticipant.objects
+        .filter(conversation_id=conv_id)
+        .values('user_id', 'user__username', 'read_up_to_msg_id')
     )
-    # 2. 对方是否已读（发送者视角）
+    participants.sort(key=lambda p: p['read_up_to_msg_id'] or 0, reverse=True)
     if conv.type == Conversation.PRIVATE:
         mate_uid = [uid for uid in conv.private_members if uid != user.user_id][0]
-        other_read_sq = MessageRead.objects.filter(
-            message=OuterRef('pk'),
-            user_id=mate_uid,
-        )
     else:
-        other_read_sq = MessageRead.objects.filter(Q(pk__isnull=True))
-    qs = Message.objects.filter(
-        conversation_id=conv_id
-    ).select_related('sender').annotate(
-        is_read_by_me=Exists(read_sq),
-        is_read_by_other=Exists(other_read_sq)
-    )
-    if last_msg_id > 0:
-        qs = qs.filter(id__lt=last_msg_id)   # 往前翻
-    qs = qs.order_by('-timestamp')[:limit]
-    msg_ids = [m.id for m in qs]          # 用于后续聚合
-    qs = reversed(qs)
-    # ---------- 群聊：一次性聚合已读成员 ----------
-    readers_map = {}
-    if conv.type == Conversation.GROUP and msg_ids:
-        readers_qs = (
-            MessageRead.objects
-            .filter(message_id__in=msg_ids)
-            .values('message_id', 'user_id', 'user__username')
-        )
-        for row in readers_qs:
-            readers_map.setdefault(row['message_id'], []).append({
-                'user_id': row['user_id'],
-                'username': row['user__username'],
-            })
+        mate_uid = None
     # 6. 序列化
     data = []
     for m in qs:
         ts = m.timestamp
         if dj_tz.is_aware(ts):
             ts = ts.astimezone(timezone.utc)
-        # 群聊：带上已读人数 + 成员列表
-        if conv.type == Conversation.GROUP:
-            readers = readers_map.get(m.id, [])
-            read_count = len(readers)
-            # is_read_by_other = False   # 群聊无意义，恒假
-        else:
-            readers = []
-            read_count = 0
+        # 群聊：带上已读人数 + 成员列表；私聊只看对方是否已读
+        read_info = services.read_state(participants, m, user.user_id, mate_uid)
         data.append({
             'id': m.id,
+            'seq': m.seq,
             'sender_id': m.sender_id,
             'sender_username': m.sender.username,
             'content': m.content,
             'timestamp': int(ts.timestamp() * 1000),
             'is_recalled': m.is_recalled,
             'parent_id': m.parent_message_id or 0,
-            'is_read': m.is_read_by_me,
-            'is_read_by_other': m.is_read_by_other,
-            'read_count': read_count,
-            'readers': readers,
+            **read_info,
         })
     return success_response(data, '消息列表获取成功')
 
@@ -558,55 +620,55 @@ def mark_as_read(request):
         return error_response(401, message='用户认证失败')
 
     msg_id = request.POST.get('msg_id')
-    msg = Message.objects.get(id=msg_id)
+    msg = Message.objects.filter(id=msg_id).first()
     if not msg:
         return error_response(401, '消息不存在')
     if msg.sender_id == user.user_id:
         return error_response(400, "不能标记自己消息为已读")
-    conv = msg.conversation
-    if not ConversationParticipant.objects.filter(
-        conversation=conv, user=user
-    ).exists():
+    try:
+        participant, receipts = services.advance_read(msg.conversation_id, user, msg.id)
+    except ConversationParticipant.DoesNotExist:
         return error_response(403, "您不在该会话中")
-    
-    read_obj, created = MessageRead.objects.get_or_create(
-        user=user,
-        message=msg,
-        defaults={"read_at": timezone.now()}
-    )
 
-    with transaction.atomic():
-        participant = ConversationParticipant.objects.select_for_update().get(
-            conversation=conv, user=user
-        )
-        # 只往后更新，防止乱序
-        if participant.read_up_to_msg_id is None or msg.id > participant.read_up_to_msg_id:
-            participant.read_up_to_msg_id = msg.id
-            participant.save(update_fields=["read_up_to_msg_id"])
-    
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        f"user_{msg.sender_id}",  # 发送方收件箱
-        {
-            "type": "msg.read",
-            "state": 200,
-            "data": {
-                "msg_id": msg.id,
-                "conv_id": msg.conversation.id,
-                "reader_id": user.user_id,
-                "reader_name": user.username,
-                "read_at": read_obj.read_at.isoformat(),
-            },
-        }
-    )
+    # 每个发送者一条合并回执
+    sends = services.read_receipts(msg.conversation_id, user, participant, receipts)
+    async_to_sync(group_send_batch)(get_channel_layer(), sends)
     return success_response(
         {
             "msg_id": msg.id,
-            "conv_id": msg.conversation.id,
+            "conv_id": msg.conversation_id,
             "reader_id": user.user_id,
             "reader_name": user.username,
-            "read_at": read_obj.read_at.isoformat(),
+            "read_at": timezone.now().isoformat(),
         },
         "已读成功"
     )
 
+
+# 批量标记已读：一次把 up_to_msg_id 及之前的消息全部标记
+@require_http_methods(["POST"])
+def mark_as_read_batch(request):
+    a_token = get_a_token(request)
+    user = get_user(a_token)
+    if not user:
+        return error_response(401, message='用户认证失败')
+    try:
+        conv_id = int(request.POST.get('conv_id'))
+        up_to_msg_id = int(request.POST.get('up_to_msg_id'))
+    except (TypeError, ValueError):
+        return error_response(400, '参数错误')
+    try:
+        participant, receipts = services.advance_read(conv_id, user, up_to_msg_id)
+    except ConversationParticipant.DoesNotExist:
+        return error_response(403, "您不在该会话中")
+
+    sends = services.read_receipts(conv_id, user, participant, receipts)
+    async_to_sync(group_send_batch)(get_channel_layer(), sends)
+    return success_response(
+        {
+            "conv_id": conv_id,
+            "read_up_to_msg_id": participant.read_up_to_msg_id,
+            "unread": participant.unread_count,
+        },
+        "已读成功"
+    )
@@ -0,0 +1,357 @@
+"""
+延迟写入（CHAT_WRITE_BEHIND=True 时启用）
+
+发送：Redis 里一次原子脚本完成 分配消息 id / 会话 seq、client_msg_id 去重、写入日志，
+     随即广播，不等数据库
+     分配前先把计数器抬到库里的最大 id / last_seq，关闭延迟写入期间直接入库的消息不会撞号
+落库：每个进程一个写入线程，抢同一把写入锁，同一时间只有持锁的那个在写，
+     批次按日志顺序（即 id 顺序）提交，补推和未读数依赖这个顺序；
+     持锁者把日志按时间窗 / 条数成批搬到处理中列表，
+     一个事务内 bulk_create + 未读数 + last_seq，提交后删除处理中列表；
+     持锁者崩溃后锁过期，下一个持锁者先重写处理中列表里没写完的那批
+     与库里别的消息撞 id / seq / client_msg_id 的条目不写，移到冲突列表并报错，等人工处理
+
+chat:wb:journal               list  待落库日志
+chat:wb:writer                string  写入锁，值为持锁线程的 token，LOCK_TTL_MS 过期
+chat:wb:processing            list  持锁者正在写的一批
+chat:wb:msg_id                string  全局消息 id
+chat:wb:seq:<conv_id>         string  会话 seq
+chat:wb:cmid:<sender>:<conv>:<client_msg_id>  string  去重，值为日志条目
+chat:wb:conflicts             list  落库时冲突的条目（带 reason）
+
+持久性取决于 Redis（需开启 AOF）；落库前的窗口内，列表 / 分页等读库接口会晚 interval 看到新消息
+各节点的 CHAT_WRITE_BEHIND 必须一致：混跑时直接入库的自增 id 可能撞上还没落库的 id，只能在落库时发现
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q, Subquery
+from django.utils import timezone
+
+from . import services
+from .db import db_read
+from .models import Conversation, Message
+from .redis_client import get_async_client, get_client
+from user.models import User
+
+JOURNAL_KEY = 'chat:wb:journal'
+PROCESSING_KEY = 'chat:wb:processing'
+LOCK_KEY = 'chat:wb:writer'
+MSG_ID_KEY = 'chat:wb:msg_id'
+CONFLICTS_KEY = 'chat:wb:conflicts'
+
+# 去重命中返回 {0, 已有条目}；成功返回 {1, 新条目}
+# ARGV[3] / ARGV[4] 为库里的最大 id / 会话 last_seq，计数器只往上抬
+# 调用方已把不在库里、id 不超过 ARGV[3] 的父消息置空
+ENQUEUE_LUA = """
+if KEYS[4] ~= '' then
+    local dup = redis.call('GET', KEYS[4])
+    if dup then return {0, dup} end
+end
+for i = 1, 2 do
+    local floor = tonumber(ARGV[2 + i])
+    if tonumber(redis.call('GET', KEYS[i]) or '0') < floor then
+        redis.call('SET', KEYS[i], floor)
+    end
+end
+local entry = cjson.decode(ARGV[1])
+-- 父消息不在库里时只可能还在日志里，即不超过已分配的最大 id
+if type(entry['parent_id']) == 'number' and entry['parent_id'] > tonumber(redis.call('GET', KEYS[1])) then
+    entry['parent_id'] = cjson.null
+end
+entry['id'] = redis.call('INCR', KEYS[1])
+entry['seq'] = redis.call('INCR', KEYS[2])
+local data = cjson.encode(entry)
+redis.call('RPUSH', KEYS[3], data)
+if KEYS[4] ~= '' then
+    redis.call('SET', KEYS[4], data, 'EX', ARGV[2])
+end
+return {1, data}
+"""
+
+# 写入锁的有效期，每领一批续一次；须大于一批落库的耗时，否则别的进程会接手同一批
+LOCK_TTL_MS = 30000
+
+# 持锁才能领：处理中列表非空说明上一批没写完，原样返回重写；否则从日志头部搬最多 n 条
+# 锁已不是自己的返回 nil
+CLAIM_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return false end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+local items = redis.call('LRANGE', KEYS[3], 0, -1)
+local n = tonumber(ARGV[3])
+if #items > 0 or n == 0 then return items end
+items = redis.call('LRANGE', KEYS[2], 0, n - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[2], #items, -1)
+    redis.call('RPUSH', KEYS[3], unpack(items))
+end
+return items
+"""
+
+# 持锁时：冲突条目移到冲突列表，删除处理中列表
+DONE_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+if #ARGV > 1 then redis.call('RPUSH', KEYS[3], unpack(ARGV, 2)) end
+redis.call('DEL', KEYS[2])
+return 1
+"""
+
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+
+def _seq_key(conv_id):
+    return f'chat:wb:seq:{conv_id}'
+
+
+def _dedupe_key(sender_id, conv_id, client_msg_id):
+    return f'chat:wb:cmid:{sender_id}:{conv_id}:{client_msg_id}' if client_msg_id else ''
+
+
+def writer_token():
+    return f'{settings.NODE_ID}:{os.getpid()}:{uuid.uuid4().hex}'
+
+
+def acquire(client, token) -> bool:
+    """抢写入锁；已经是自己的也算"""
+    return bool(client.set(LOCK_KEY, token, nx=True, px=LOCK_TTL_MS)) or client.get(LOCK_KEY) == token
+
+
+def release(client, token):
+    client.register_script(RELEASE_LUA)(keys=[LOCK_KEY], args=[token])
+
+
+# ---------- 发送 ----------
+async def send_message(conv_id, sender, content, parent_id=None, meta=None, client_msg_id=None):
+    """
+    与 services.send_message 同样的入参和返回值，只读一次库（计数器下限、已落库的重发），不等落库
+    返回 (meta, payload, 其他成员 user_id 列表, 是否新消息)
+    """
+    if meta is None:
+        meta = await services.aload_conv_meta(conv_id)
+    services.check_can_send(meta, sender.user_id)
+    other_uids = [uid for uid in meta['member_ids'] if uid != sender.user_id]
+    try:
+        parent_id = int(parent_id) if parent_id else None
+    except (TypeError, ValueError):
+        parent_id = None
+
+    last_id, last_seq, existing, parent_in_db = await _db_state(
+        conv_id, sender.user_id, client_msg_id, parent_id
+    )
+    if parent_id and not parent_in_db and parent_id <= last_id:
+        # 不在库里、也不可能还在日志里：与直接写入一样当作没有父消息
+        parent_id = None
+    if existing is not None:
+        # 去重记录过期后的重发：库里已有，不再分配
+        return meta, services.message_payload(existing, sender, conv_id), other_uids, False
+
+    client = get_async_client()
+    enqueue = client.register_script(ENQUEUE_LUA)
+    keys = [MSG_ID_KEY, _seq_key(conv_id), JOURNAL_KEY,
+            _dedupe_key(sender.user_id, conv_id, client_msg_id)]
+    args = [json.dumps({
+        'conv_id': conv_id,
+        'sender_id': sender.user_id,
+        'content': content,
+        'parent_id': parent_id,
+        'client_msg_id': client_msg_id,
+        'ts': timezone.now().isoformat(),
+    }), settings.CHAT_DEDUPE_TTL, last_id, last_seq]
+
+    status, data = await enqueue(keys=keys, args=args)
+    ensure_writer()
+    msg = _to_message(json.loads(data))
+    return meta, services.message_payload(msg, sender, conv_id), other_uids, status == 1
+
+
+@db_read
+async def _db_state(conv_id, sender_id, client_msg_id, parent_id):
+    """库里的最大消息 id、会话 last_seq、父消息是否在库里，以及同一 client_msg_id 已落库的消息"""
+    last_seq, last_id, parent = await Conversation.objects.filter(pk=conv_id).annotate(
+        last_id=Subquery(Message.objects.order_by('-id').values('id')[:1]),
+        parent=Subquery(Message.objects.filter(pk=parent_id or 0).values('id')[:1]),
+    ).values_list('last_seq', 'last_id', 'parent').aget()
+    existing = None
+    if client_msg_id:
+        existing = await Message.objects.filter(
+            sender_id=sender_id, conversation_id=conv_id, client_msg_id=client_msg_id
+        ).afirst()
+    return last_id or 0, last_seq, existing, parent is not None
+
+
+def _to_message(entry) -> Message:
+    return Message(
+        id=entry['id'],
+        seq=entry['seq'],
+        conversation_id=entry['conv_id'],
+        sender_id=entry['sender_id'],
+        content=entry['content'],
+        parent_message_id=entry['parent_id'],
+        client_msg_id=entry['client_msg_id'],
+        timestamp=datetime.fromisoformat(entry['ts']),
+    )
+
+
+# ---------- 落库 ----------
+def write_batch(entries):
+    """
+    一批日志一个事务落库，可重复执行：
+    已在库里且会话 / 发送者 / seq / 内容 / 时间都一致的条目是重放，跳过且不重复加未读；
+    id、(会话, seq)、client_msg_id 被库里别的消息占用的条目不写，作为冲突返回；
+    外键已失效的条目丢弃，避免整批卡死
+    返回 (写入条数, 冲突条目列表)
+    """
+    msgs = sorted(zip(map(_to_message, entries), entries), key=lambda p: p[0].id)
+    if not msgs:
+        return 0, []
+    conflicts = []
+
+    def conflict(m, entry, reason):
+        print(f'[write-behind] 消息 {m.id} 冲突，未落库：{reason}')
+        conflicts.append({**entry, 'reason': reason})
+
+    written = {
+        row[0]: row[1:] for row in Message.objects.filter(
+            id__in=[m.id for m, _ in msgs]
+        ).values_list('id', 'conversation_id', 'sender_id', 'seq', 'client_msg_id', 'content', 'timestamp')
+    }
+    seq_cond, cmid_cond = Q(), Q()
+    for m, _ in msgs:
+        seq_cond |= Q(conversation_id=m.conversation_id, seq=m.seq)
+        if m.client_msg_id:
+            cmid_cond |= Q(sender_id=m.sender_id, conversation_id=m.conversation_id,
+                           client_msg_id=m.client_msg_id)
+    seq_taken = {
+        (conv_id, seq): msg_id for msg_id, conv_id, seq in
+        Message.objects.filter(seq_cond).values_list('id', 'conversation_id', 'seq')
+    }
+    cmid_taken = {
+        (sender_id, conv_id, cmid): msg_id for msg_id, sender_id, conv_id, cmid in
+        Message.objects.filter(cmid_cond).values_list(
+            'id', 'sender_id', 'conversation_id', 'client_msg_id'
+        )
+    } if cmid_cond else {}
+    conv_ids = set(Conversation.objects.filter(
+        id__in={m.conversation_id for m, _ in msgs}
+    ).values_list('id', flat=True))
+    user_ids = set(User.objects.filter(
+        user_id__in={m.sender_id for m, _ in msgs}
+    ).values_list('user_id', flat=True))
+
+    rows, taken_ids = [], set()
+    for m, entry in msgs:
+        seq_key = (m.conversation_id, m.seq)
+        cmid_key = (m.sender_id, m.conversation_id, m.client_msg_id)
+        if m.id in written:
+            if written[m.id] != (m.conversation_id, m.sender_id, m.seq,
+                                 m.client_msg_id, m.content, m.timestamp):
+                taken_ids.add(m.id)
+                conflict(m, entry, f'id 已被会话 {written[m.id][0]} seq {written[m.id][2]} 的消息占用')
+            continue
+        if m.conversation_id not in conv_ids or m.sender_id not in user_ids:
+            print(f'[write-behind] 丢弃消息 {m.id}：会话或发送者已不存在')
+            continue
+        if seq_key in seq_taken:
+            conflict(m, entry, f'seq 已被消息 {seq_taken[seq_key]} 占用')
+            continue
+        if m.client_msg_id and cmid_key in cmid_taken:
+            conflict(m, entry, f'client_msg_id 已被消息 {cmid_taken[cmid_key]} 占用')
+            continue
+        seq_taken[seq_key] = m.id
+        if m.client_msg_id:
+            cmid_taken[cmid_key] = m.id
+        rows.append(m)
+
+    # 父消息可以在同一批里，也可以已在库里（不能是占了冲突 id 的别的消息）
+    row_ids = {m.id for m in rows}
+    wanted = {m.parent_message_id for m in rows if m.parent_message_id} - row_ids - taken_ids
+    valid_parents = row_ids | set(Message.objects.filter(id__in=wanted).values_list('id', flat=True))
+    for m in rows:
+        if m.parent_message_id not in valid_parents:
+            m.parent_message_id = None
+
+    # 未读数和 last_seq 只按真正插入的行算；插入时仍撞约束（并发直接入库）整批回滚，下一轮重查
+    unread = defaultdict(list)
+    last_seq = defaultdict(int)
+    for m in rows:
+        unread[m.conversation_id, m.sender_id].append(m.id)
+        last_seq[m.conversation_id] = max(last_seq[m.conversation_id], m.seq)
+
+    with transaction.atomic():
+        Message.objects.bulk_create(rows)
+        for (conv_id, sender_id), msg_ids in unread.items():
+            services.bump_unread(conv_id, sender_id, msg_ids)
+        for conv_id, seq in last_seq.items():
+            Conversation.objects.filter(pk=conv_id, last_seq__lt=seq).update(last_seq=seq)
+    return len(rows), conflicts
+
+
+def flush_once(client, token, batch_size):
+    """
+    持锁处理一批：先重写上一批没写完的，否则从日志领一批（batch_size 为 0 时只重写不领）
+    写成功后把冲突条目移到冲突列表、删除处理中列表；返回本批条数，锁已丢失返回 None
+    """
+    claim = client.register_script(CLAIM_LUA)
+    entries = claim(keys=[LOCK_KEY, JOURNAL_KEY, PROCESSING_KEY], args=[token, LOCK_TTL_MS, batch_size])
+    if entries is None:
+        return None
+    if not entries:
+        return 0
+    close_old_connections()
+    try:
+        _, conflicts = write_batch([json.loads(e) for e in entries])
+    finally:
+        close_old_connections()
+    done = client.register_script(DONE_LUA)
+    if not done(keys=[LOCK_KEY, PROCESSING_KEY, CONFLICTS_KEY], args=[token, *map(json.dumps, conflicts)]):
+        # 写的过程中锁过期、已被别人接手：这批会被重写一次，按重放跳过
+        return None
+    return len(entries)
+
+
+def _run_writer():
+    client = get_client()
+    token = writer_token()
+    atexit.register(release, client, token)
+    batch_size = settings.CHAT_WRITE_BEHIND_BATCH
+    interval = settings.CHAT_WRITE_BEHIND_INTERVAL_MS / 1000
+    while True:
+        try:
+            if not acquire(client, token):
+                # 别的进程在写
+                time.sleep(max(interval, 1))
+                continue
+            n = flush_once(client, token, batch_size)
+        except Exception as e:
+            # 数据库 / Redis 暂时不可用：保留处理中列表，稍后重试
+            print('[write-behind] 落库失败，稍后重试:', e)
+            time.sleep(max(interval, 1))
+            continue
+        if n is not None and n < batch_size:
+            time.sleep(interval)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def ensure_writer():
+    """本进程第一次延迟写入时启动写入线程"""
+    global _writer
+    if _writer is not None:
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_run_writer, name='chat-write-behind', daemon=True)
+            _writer.start()
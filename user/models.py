@@ -84,4 +84,9 @@ class User(models.Model):
 
     class Meta:
         db_table = 'user'
+        indexes = [
+            # 用户列表按创建 / 更新时间范围筛选
+            models.Index(fields=['created_at'], name='user_created_at_idx'),
+            models.Index(fields=['updated_at'], name='user_updated_at_idx'),
+        ]
 
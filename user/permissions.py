@@ -0,0 +1,120 @@
+from functools import wraps
+
+from django.conf import settings
+
+from utils.cache import TTLCache, shared_cache
+from utils.response import error_response
+from utils.user import get_a_token, get_user
+from .models import CaiDan, Permission2, Role, User
+
+# 按角色派生的数据（权限 id 集合、菜单树），进程内缓存 + 可选共享缓存
+_role_cache = TTLCache(maxsize=2048, ttl=settings.ROLE_CACHE_LOCAL_TTL)
+
+
+def _perms_key(role_id):
+    return f'auth:role_perms:{role_id}'
+
+
+def _menu_key(role_id):
+    return f'auth:role_menu:{role_id}'
+
+
+def _cached(key, build):
+    value = _role_cache.get(key)
+    if value is not None:
+        return value
+    shared = shared_cache()
+    if shared is not None:
+        value = shared.get(key)
+    if value is None:
+        value = build()
+        if shared is not None:
+            shared.set(key, value, settings.ROLE_CACHE_SHARED_TTL)
+    _role_cache.set(key, value)
+    return value
+
+
+def role_permission_ids(role_id) -> frozenset:
+    return _cached(_perms_key(role_id), lambda: frozenset(
+        Role.permission2.through.objects
+        .filter(role_id=role_id)
+        .values_list('permission2_id', flat=True)
+    ))
+
+
+def _build_menu_tree(role_id) -> list:
+    # 二级菜单连表一次取出，一级菜单再一次取出，按 auth_pid 分组
+    caidan2s_all = [
+        _.caidan2 for _ in
+        Permission2.objects.filter(roles=role_id).select_related('caidan2').order_by('permission2_id')
+    ]
+    children = {}
+    for c2 in caidan2s_all:
+        children.setdefault(c2.auth_pid, []).append(c2)
+    caidans = CaiDan.objects.filter(auth_id__in=children.keys()).order_by('auth_id')
+    return [{
+        'auth_id': menu_item.auth_id,
+        'icon': menu_item.icon,
+        'auth_name': menu_item.auth_name,
+        'path': menu_item.path,
+        'type': menu_item.type,
+        'auth_pid': menu_item.auth_pid,
+        'auth_pname': menu_item.auth_pname,
+        'keep_alive': menu_item.keep_alive,
+        'component': menu_item.component,
+        'sort': menu_item.sort,
+        'created_at': menu_item.created_at,
+        'updated_at': menu_item.updated_at,
+        'children': [{
+            'auth_id': int(f'{menu_item.auth_id}0{_.auth_id}'),
+            'icon': _.icon,
+            'auth_name': _.auth_name,
+            'path': _.path,
+            'type': _.type,
+            'auth_pid': _.auth_pid,
+            'auth_pname': _.auth_pname,
+            'keep_alive': _.keep_alive,
+            'component': _.component,
+            'sort': _.sort,
+            'created_at': _.created_at,
+            'updated_at': _.updated_at,
+        } for _ in children[menu_item.auth_id]]
+    } for menu_item in caidans]
+
+
+def role_menu_tree(role_id) -> list:
+    """角色的菜单树，只随角色权限变化"""
+    return _cached(_menu_key(role_id), lambda: _build_menu_tree(role_id))
+
+
+def invalidate_role(role_id):
+    """角色权限变更 / 角色删除后重建"""
+    keys = [_perms_key(role_id), _menu_key(role_id)]
+    for key in keys:
+        _role_cache.delete(key)
+    shared = shared_cache()
+    if shared is not None:
+        shared.delete_many(keys)
+
+
+def verify_auth(user, permission) -> bool:
+    return permission in role_permission_ids(user.role_id)
+
+
+def require_permission(permission2_id):
+    """视图装饰器：校验登录和角色权限，通过后当前用户挂在 request.auth_user 上"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            try:
+                user = get_user(get_a_token(request))
+            except User.DoesNotExist:
+                return error_response(400, '用户id错误')
+            if not user:
+                return error_response(401, message='用户认证失败')
+            if not verify_auth(user, permission2_id):
+                return error_response(400, '权限不足')
+            request.auth_user = user
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,3 +1,67 @@
 from django.test import TestCase
 
-# Create your tests here.
+from utils.token import create_access_token
+from utils.user import invalidate_user
+from .models import CaiDan, CaiDan2, Permission, Permission2, Role, User
+from .permissions import invalidate_role
+
+# role_list 需要的二级权限 id，见 user/views.py 上的 require_permission
+ROLE_LIST_PERMISSION = 8
+
+
+class RoleListQueryCountTests(TestCase):
+    """role_list 的查询数与角色 / 权限数量无关"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Role.objects.create(role_id=5, role_name='普通用户')
+        cls.admin_role = Role.objects.create(role_id=1, role_name='admin')
+        menu = CaiDan.objects.create(auth_name='m')
+        cls.perm = Permission.objects.create(permission_name='p')
+        cls.perm2 = Permission2.objects.create(
+            permission2_id=ROLE_LIST_PERMISSION, permission2_name='角色列表',
+            caidan2=CaiDan2.objects.create(auth_name='c', auth_pid=menu.auth_id),
+        )
+        cls.perm.permission2.add(cls.perm2)
+        cls.admin_role.permission.add(cls.perm)
+        cls.admin_role.permission2.add(cls.perm2)
+        cls.admin = User.objects.create(username='adm', mobile='13900000000', role=cls.admin_role)
+
+    def setUp(self):
+        # 进程内缓存跨用例保留，先清掉
+        invalidate_user(self.admin.user_id)
+        invalidate_role(self.admin_role.role_id)
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + create_access_token(
+            self.admin.user_id, self.admin_role.role_id
+        )}
+
+    def get_role_list(self):
+        return self.client.get('/user/role_list/?pagenum=1&pagesize=50', **self.auth)
+
+    def add_roles(self, n, perms_per_role):
+        for i in range(n):
+            menu = CaiDan.objects.create(auth_name=f'm{i}')
+            perm = Permission.objects.create(permission_name=f'p{i}')
+            perm2s = [
+                Permission2.objects.create(
+                    permission2_name=f'pp{i}-{j}',
+                    caidan2=CaiDan2.objects.create(auth_name=f'c{i}-{j}', auth_pid=menu.auth_id),
+                )
+                for j in range(perms_per_role)
+            ]
+            perm.permission2.add(*perm2s)
+            role = Role.objects.create(role_name=f'r{i}')
+            role.permission.add(perm)
+            role.permission2.add(*perm2s)
+
+    def test_query_count_is_fixed(self):
+        # 预热：用户和角色权限进缓存，之后只剩 role_list 本身的查询
+        self.assertEqual(self.get_role_list().status_code, 200)
+        # count + 角色 + 一级权限 + 二级权限 + 二级权限所属一级权限
+        with self.assertNumQueries(5):
+            self.get_role_list()
+
+        self.add_roles(10, perms_per_role=5)
+        with self.assertNumQueries(5):
+            response = self.get_role_list()
+        self.assertEqual(response.json()['total'], 12)
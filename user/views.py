@@ -2,24 +2,20 @@ import re
 
 from django.http import JsonResponse
 
-from .models import User, Role, Permission, Permission2, CaiDan
+from .models import User, Role, Permission, Permission2
+from django.db import connection
+from django.db.models import Prefetch
 from datetime import datetime
 from django.utils import timezone
 
 from django.core.paginator import Paginator
-from utils.user import get_user, get_a_token
+from utils.user import get_user, get_a_token, invalidate_user
+from .permissions import invalidate_role, require_permission, role_menu_tree
 from utils import token
 from utils.response import success_response, error_response
 from datetime import timedelta
 
 
-def verify_auth(userid, permission) -> bool:
-    user = User.objects.get(user_id__exact=userid)
-    role = Role.objects.get(role_id__exact=user.role_id)
-    permissions = [_.permission2_id for _ in role.permission2.all()]
-    return permission in permissions
-
-
 def test(request):
     a_token = get_a_token(request)
     user = get_user(a_token)
@@ -122,8 +118,8 @@ def refresh_token(request):
         return error_response(403, decoded['msg'])
 
 
+@require_permission(7)
 def create_user(request):
-    create_user_permission2_id = 7
     """
     用户注册接口
     user_id: number
@@ -140,15 +136,6 @@ def create_user(request):
     """
     if request.method != 'POST':
         return error_response(405, 'Method Not Allowed')
-    try:
-        a_token = get_a_token(request)
-        user = get_user(a_token)
-        if not user:
-            return error_response(401, message='用户认证失败')
-        if not verify_auth(user.user_id, create_user_permission2_id):
-            return error_response(400, '权限不足')
-    except:
-        return error_response(400, '用户id错误')
     # 手机号正则表达式（中国标准）
     MOBILE_REGEX = r'^1[3-9]\d{9}$'
     try:
@@ -203,69 +190,82 @@ def create_user(request):
         return error_response(500, "服务器内部错误")
 
 
+@require_permission(6)
 def user_list(request):
-    user_list_permission2_id = 6
     def convert_tstamp_to_iso(timestamp: str) -> datetime:
         seconds = int(timestamp) // 1000
         aware_time = datetime.fromtimestamp(seconds, tz=timezone.utc)
         return aware_time
     """
     请求
-    pagenum: number
+    last_user_id?: number  游标，上一页最后一个 user_id，传了就走键集分页
+    pagenum?: number       不传游标时按页码翻页（兼容旧前端）
     pagesize: number
     username: string
     mobile: string
+    role_id: number
     role_name: string
     created_at: string
     updated_at: string
+    total?: exact | estimate | none  总数统计方式，默认有游标时不统计
     """
     if request.method != 'GET':
         return error_response(405, 'Method Not Allowed')
-    try:
-        a_token = get_a_token(request)
-        user = get_user(a_token)
-        if not user:
-            return error_response(401, message='用户认证失败')
-
-        if not verify_auth(user.user_id, user_list_permission2_id):
-            return error_response(400, '权限不足')
-    except:
-        return error_response(400, '用户id错误')
-    pagenum = request.GET.get('pagenum')
-    pagesize = request.GET.get('pagesize')
     username = request.GET.get('username')
     mobile = request.GET.get('mobile')
+    role_id = request.GET.get('role_id')
     role_name = request.GET.get('role_name')
     created_at = request.GET.get('created_at')
     updated_at = request.GET.get('updated_at')
     try:
-        pagenum = int(pagenum) if pagenum else 1
-        pagesize = int(pagesize) if pagesize else 10
-    except Exception as e:
-        pass
-
-    users = User.objects.all().order_by("-user_id")  # 示例查询
+        last_user_id = int(request.GET.get('last_user_id') or 0)
+        pagenum = max(1, int(request.GET.get('pagenum') or 1))
+        pagesize = max(1, min(int(request.GET.get('pagesize') or 10), 100))
+        role_id = int(role_id) if role_id else None
+    except ValueError:
+        return error_response(400, '分页参数非法')
+    total_mode = request.GET.get('total') or ('none' if last_user_id else 'exact')
+
+    # 过滤条件都落在索引上：username / mobile 唯一索引，role_id 外键索引，created_at / updated_at 普通索引
+    users = User.objects.select_related('role').order_by("-user_id")
+    filtered = False
     if username:
-        users = User.objects.filter(username__exact=username)
-    elif mobile:
+        users = users.filter(username__exact=username)
+        filtered = True
+    if mobile:
         users = users.filter(mobile__exact=mobile)
+        filtered = True
+    if role_id:
+        users = users.filter(role_id=role_id)
+        filtered = True
     elif role_name:
-        users = users.filter(role_name__exact=role_name)
-    elif created_at:
-        if created_at.__len__() == 27:
-            created_at = list(map(convert_tstamp_to_iso, created_at.split('-')))
-            users = users.filter(created_at__range=(created_at[0], created_at[1]))
-    elif updated_at:
-        if updated_at.__len__() == 27:
-            updated_at = list(map(convert_tstamp_to_iso, updated_at.split('-')))
-            users = users.filter(updated_at__range=(updated_at[0], updated_at[1]))
+        users = users.filter(role_id__in=Role.objects.filter(role_name__exact=role_name).values('role_id'))
+        filtered = True
+    if created_at and created_at.__len__() == 27:
+        created_at = list(map(convert_tstamp_to_iso, created_at.split('-')))
+        users = users.filter(created_at__range=(created_at[0], created_at[1]))
+        filtered = True
+    if updated_at and updated_at.__len__() == 27:
+        updated_at = list(map(convert_tstamp_to_iso, updated_at.split('-')))
+        users = users.filter(updated_at__range=(updated_at[0], updated_at[1]))
+        filtered = True
+
+    # 总数：exact 精确 COUNT，estimate 无过滤时读表统计信息，none 不统计
+    if total_mode == 'none':
+        total = None
+    elif total_mode == 'estimate' and not filtered:
+        total = _estimated_row_count(User)
+    else:
+        total = users.count()
+
+    if last_user_id:
+        # 键集分页：沿主键索引直接定位，不扫描前面的行
+        page = list(users.filter(user_id__lt=last_user_id)[:pagesize])
     else:
-        pass
-    paginator = Paginator(users, pagesize)
-    page_obj = paginator.get_page(pagenum)  # 自动处理无效页码
+        page = list(users[(pagenum - 1) * pagesize:pagenum * pagesize])
     # 构建响应数据
     u_list = []
-    for user in page_obj:
+    for user in page:
         u_list.append({
             'user_id': user.user_id,
             'username': user.username,
@@ -280,30 +280,36 @@ def user_list(request):
     response_data = {
         'state': 200,
         'msg': '用户列表获取成功',
-        "current_page": page_obj.number,
+        "current_page": None if last_user_id else pagenum,
         "page_size": pagesize,
-        'total': paginator.count,
-        'total_pages': paginator.num_pages,
+        'total': total,
+        'total_pages': None if total is None else max(1, -(-total // pagesize)),
+        'next_cursor': page[-1].user_id if len(page) == pagesize else None,
         'list': u_list
     }
     # 返回带token的响应
     return JsonResponse(response_data, status=200)
 
 
+def _estimated_row_count(model) -> int:
+    """MySQL 读 information_schema 的行数估算，避免大表 COUNT(*)，其他数据库退回精确统计"""
+    if connection.vendor != 'mysql':
+        return model.objects.count()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT TABLE_ROWS FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+            [model._meta.db_table],
+        )
+        row = cursor.fetchone()
+    return int(row[0] or 0) if row else 0
+
+
+@require_permission(7)
 def update_user(request):
-    update_user_permission2_id = 7
     if request.method != 'POST':
         return error_response(405, "Method Not Allowed")
-    try:
-        a_token = get_a_token(request)
-        user = get_user(a_token)
-        if not user:
-            return error_response(401, message='用户认证失败')
-        if not verify_auth(user.user_id, update_user_permission2_id):
-            return error_response(400, '权限不足')
-    except:
-        return error_response(400, '用户id错误')
-        # 手机号正则表达式（中国标准）
+    # 手机号正则表达式（中国标准）
     MOBILE_REGEX = r'^1[3-9]\d{9}$'
     try:
         # 2. 参数提取与基本校验
@@ -341,13 +347,14 @@ def update_user(request):
             else:
                 return error_response(400, "密码长度6-16位")
         user.save()
+        invalidate_user(user.user_id)
         return success_response(message="更新用户成功")
     except Exception as e:
         return error_response(500, "服务器内部错误")
 
 
+@require_permission(9)
 def change_user_role(request):
-    change_user_role_permission2_id = 9
     """
     请求
     username: string
@@ -357,16 +364,6 @@ def change_user_role(request):
     """
     if request.method != 'POST':
         return error_response(405, "Method Not Allowed")
-    try:
-        a_token = get_a_token(request)
-        user = get_user(a_token)
-        if not user:
-            return error_response(401, message='用户认证失败')
-
-        if not verify_auth(user.user_id, change_user_role_permission2_id):
-            return error_response(400, '权限不足')
-    except:
-        return error_response(400, '用户id错误')
     user_id = request.POST.get('user_id')
     role_id = request.POST.get('role_id')
     role_name = request.POST.get('role_name')
@@ -376,6 +373,7 @@ def change_user_role(request):
             user.role_id = role_id
             user.role_name = role_name
             user.save()
+            invalidate_user(user.user_id)
             return success_response(message="更新角色成功")
         else:
             return error_response(400, "请求参数错误")
@@ -383,29 +381,21 @@ def change_user_role(request):
         return error_response(500, "服务器内部错误")
 
 
+@require_permission(7)
 def delete_user(request):
-    delete_user_permission2_id = 7
     if request.method != 'POST':
         return error_response(405, "Method Not Allowed")
-    try:
-        a_token = get_a_token(request)
-        user = get_user(a_token)
-        if not user:
-            return error_response(401, message='用户认证失败')
-
-        if not verify_auth(user.user_id, delete_user_permission2_id):
-            return error_response(400, '权限不足')
-    except:
-        return error_response(400, '用户id错误')
     try:
         del_user_id = request.POST.get('del_user_id')
         user = User.objects.get(user_id__exact=del_user_id)
         user.delete()
+        invalidate_user(del_user_id)
         return success_response(message="用户删除成功")
     except Exception as e:
         return error_response(500, "服务器内部错误")
 
 
+@require_permission(8)
 def role_list(request):
     """
     请求
@@ -422,19 +412,12 @@ def role_list(request):
     role_name: string
     updated_at: string
     """
-    role_list_permission2_id = 8
-    try:
-        a_token = get_a_token(request)
-        user = get_user(a_token)
-        if not user:
-            return error_response(401, message='用户认证失败')
-
-        if not verify_auth(user.user_id, role_list_permission2_id):
-            return error_response(400, '权限不足')
-    except:
-        return error_response(400, '用户id错误')
     r_list = []
-    roles = Role.objects.all().order_by("role_id")
+    # 权限、二级权限及其所属一级权限一次预取，查询数与角色 / 权限数量无关
+    roles = Role.objects.all().order_by("role_id").prefetch_related(
+        'permission',
+        Prefetch('permission2', queryset=Permission2.objects.prefetch_related('permissions')),
+    )
     pagenum = request.GET.get('pagenum')
     pagesize = request.GET.get('pagesize')
     role_name = request.GET.get('role_name')
@@ -448,7 +431,11 @@ def role_list(request):
         for role in page_obj:
             permissions = role.permission.all()
             auth_ids = ','.join([f'{_.permission_id}' for _ in permissions])
-            auth_ids_son = ','.join(f'{_.permissions.first().permission_id}0{_.permission2_id}' for _ in role.permission2.all())
+            # 用预取结果取所属一级权限（id 最小的一个），.first() 会绕过预取重新查库
+            auth_ids_son = ','.join(
+                f'{min(_.permissions.all(), key=lambda p: p.permission_id).permission_id}0{_.permission2_id}'
+                for _ in role.permission2.all() if _.permissions.all()
+            )
             r_list.append({
                 'role_id': role.role_id,
                 'role_name': role.role_name,
@@ -472,20 +459,10 @@ def role_list(request):
         return error_response(500, "服务器内部错误")
 
 
+@require_permission(9)
 def create_role(request):
-    create_role_permission2_id = 9
     if request.method != 'POST':
         return error_response(405, "Method Not Allowed")
-    try:
-        a_token = get_a_token(request)
-        user = get_user(a_token)
-        if not user:
-            return error_response(401, message='用户认证失败')
-
-        if not verify_auth(user.user_id, create_role_permission2_id):
-            return error_response(400, '权限不足')
-    except:
-        return error_response(400, '用户id错误')
     role_name = request.POST.get('role_name')
     role_desc = request.POST.get('role_desc')
     try:
@@ -496,23 +473,13 @@ def create_role(request):
         return error_response(500, "服务器内部错误")
 
 
+@require_permission(9)
 def update_role(request):
     """
     role_id: number
     role_name: string
     role_desc?: string
     """
-    update_role_permission2_id = 9
-    try:
-        a_token = get_a_token(request)
-        user = get_user(a_token)
-        if not user:
-            return error_response(401, message='用户认证失败')
-
-        if not verify_auth(user.user_id, update_role_permission2_id):
-            return error_response(400, '权限不足')
-    except:
-        return error_response(400, '用户id错误')
     role_id = request.POST.get('role_id')
     role_name = request.POST.get('role_name')
     role_desc = request.POST.get('role_desc')
@@ -521,34 +488,27 @@ def update_role(request):
         role.role_name = role_name
         role.role_desc = role_desc
         role.save()
+        invalidate_role(role.role_id)
         return success_response(message="更新角色成功")
     except Exception as e:
         return error_response(500, "服务器内部错误")
 
 
+@require_permission(9)
 def delete_role(request):
-    delete_role_permission2_id = 9
     if request.method != 'POST':
         return error_response(405, "Method Not Allowed")
-    try:
-        a_token = get_a_token(request)
-        user = get_user(a_token)
-        if not user:
-            return error_response(401, message='用户认证失败')
-
-        if not verify_auth(user.user_id, delete_role_permission2_id):
-            return error_response(400, '权限不足')
-    except:
-        return error_response(400, '用户id错误')
     try:
         role_id = request.POST.get('role_id')
         role = Role.objects.get(role_id__exact=role_id)
         role.delete()
+        invalidate_role(role_id)
         return success_response(message="删除角色成功")
     except Exception as e:
         return error_response(500, "服务器内部错误")
 
 
+@require_permission(11)
 def change_role_permission(request):
     """
     role_name: string
@@ -557,18 +517,9 @@ def change_role_permission(request):
     auth_ids_son: string
     1 超级管理员 1,2,3,4,5 101,102,203,204,205,306,307,408,409,5010,5011
     """
-    change_role_permission_permission2_id = 11
     if request.method != 'POST':
         return error_response(405, "Method Not Allowed")
     try:
-        a_token = get_a_token(request)
-        user = get_user(a_token)
-        if not user:
-            return error_response(401, message='用户认证失败')
-
-        if not verify_auth(user.user_id, change_role_permission_permission2_id):
-            return error_response(400, '权限不足')
-
         user_id = request.POST.get('user_id')
         if int(user_id) == 1:
             return error_response(400, '禁止修改此角色')
@@ -586,6 +537,7 @@ def change_role_permission(request):
         permission2 = Permission2.objects.filter(permission2_id__in=auth_ids_son)
         role.permission.set(permission)
         role.permission2.set(permission2)
+        invalidate_role(role.role_id)
         return success_response(message="角色权限更新成功")
     except Exception as e:
         return error_response(500, "服务器内部错误")
@@ -601,42 +553,8 @@ def menu_list(request):
         return error_response(401, message='用户认证失败')
 
     try:
-        role_id = user.role_id
-        role = Role.objects.get(role_id__exact=role_id)
-        caidan2s_all = [_.caidan2 for _ in role.permission2.all()]
-        caidans = list(set(CaiDan.objects.get(auth_id__exact=_.auth_pid) for _ in caidan2s_all))
-        data = []
-        for menu_item in caidans:
-            caidan2s = [_ for _ in caidan2s_all if _.auth_pid == menu_item.auth_id]
-            data.append({
-                'auth_id': menu_item.auth_id,
-                'icon': menu_item.icon,
-                'auth_name': menu_item.auth_name,
-                'path': menu_item.path,
-                'type': menu_item.type,
-                'auth_pid': menu_item.auth_pid,
-                'auth_pname': menu_item.auth_pname,
-                'keep_alive': menu_item.keep_alive,
-                'component': menu_item.component,
-                'sort': menu_item.sort,
-                'created_at': menu_item.created_at,
-                'updated_at': menu_item.updated_at,
-                'children': [{
-                    'auth_id': int(f'{menu_item.auth_id}0{_.auth_id}'),
-                    'icon': _.icon,
-                    'auth_name': _.auth_name,
-                    'path': _.path,
-                    'type': _.type,
-                    'auth_pid': _.auth_pid,
-                    'auth_pname': _.auth_pname,
-                    'keep_alive': _.keep_alive,
-                    'component': _.component,
-                    'sort': _.sort,
-                    'created_at': _.created_at,
-                    'updated_at': _.updated_at,
-                } for _ in caidan2s]
-            })
-
+        # 菜单树按角色缓存，change_role_permission 时失效
+        data = role_menu_tree(user.role_id)
         return success_response(message="获取菜单列表成功", data=data)
     except Exception as e:
         return error_response(500, "服务器内部错误")
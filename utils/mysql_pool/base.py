@@ -0,0 +1,43 @@
+"""
+带连接池的 MySQL 后端：ENGINE = "utils.mysql_pool"
+Django 关闭连接时把连接还回池里，而不是真正断开；
+配合 CONN_MAX_AGE = 0，每个请求 / 每次 consumer 的 DB 调用结束即归还
+"""
+from django.db.backends.mysql import base
+
+from .pool import get_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict.get('POOL', {}))
+
+    def get_new_connection(self, conn_params):
+        return self.pool.acquire(
+            create=lambda: super(DatabaseWrapper, self).get_new_connection(conn_params),
+            ping=_ping,
+        )
+
+    def _close(self):
+        if self.connection is None:
+            return
+        reusable = True
+        try:
+            # 未提交的事务不能带回池里
+            if not self.autocommit or self.in_atomic_block:
+                self.connection.rollback()
+            if self.errors_occurred:
+                reusable = _ping(self.connection)
+        except Exception:
+            reusable = False
+        self.pool.release(self.connection, reusable=reusable)
+
+
+def _ping(conn) -> bool:
+    try:
+        conn.ping()
+    except Exception:
+        return False
+    return True
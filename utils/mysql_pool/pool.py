@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    """等待空闲连接超时"""
+
+
+class ConnectionPool:
+    """
+    进程内数据库连接池，线程安全
+    max_size 限制同时打开的连接总数，空闲连接按后进先出复用，
+    超过 recycle 秒的连接不再复用，取出时可先 ping 一次做健康检查
+    """
+
+    def __init__(self, max_size, timeout=10, recycle=1800, pre_ping=True):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._born = {}
+        self._in_use = 0
+        self._created = 0
+        self._reused = 0
+        self._discarded = 0
+        self._timeouts = 0
+
+    def acquire(self, create, ping):
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout(f'等待数据库连接超时（池大小 {self.max_size}）')
+        try:
+            conn = self._take_idle(ping)
+            if conn is None:
+                conn = create()
+                with self._lock:
+                    self._born[id(conn)] = time.monotonic()
+                    self._created += 1
+            with self._lock:
+                self._in_use += 1
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _take_idle(self, ping):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return None
+            born = self._born.get(id(conn), 0)
+            if time.monotonic() - born > self.recycle or (self.pre_ping and not ping(conn)):
+                self._discard(conn)
+                continue
+            with self._lock:
+                self._reused += 1
+            return conn
+
+    def release(self, conn, reusable=True):
+        with self._lock:
+            self._in_use -= 1
+        if reusable:
+            self._idle.put(conn)
+        else:
+            self._discard(conn)
+        self._slots.release()
+
+    def _discard(self, conn):
+        with self._lock:
+            self._born.pop(id(conn), None)
+            self._discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'created': self._created,
+                'reused': self._reused,
+                'discarded': self._discarded,
+                'timeouts': self._timeouts,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, options) -> ConnectionPool:
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = ConnectionPool(**options)
+        return pool
+
+
+def pool_stats() -> dict:
+    """各数据库别名的连接池指标"""
+    with _pools_lock:
+        pools = dict(_pools)
+    return {alias: pool.stats() for alias, pool in pools.items()}
@@ -1,18 +1,49 @@
+import time
+
+from django.conf import settings
+
 from . import token
+from .cache import TTLCache, shared_cache
 from user.models import User
 from utils.response import error_response
 
+# 已认证用户快照：进程内 LRU + 可选共享缓存，有效期不超过 token 剩余寿命
+_user_cache = TTLCache(maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_LOCAL_TTL)
+
+
+def _user_key(user_id):
+    return f'auth:user:{user_id}'
+
 
 def get_user(a_token):
     decoded = token.decode_access_token(a_token)
     if decoded['state'] == 1:
         user_id = decoded['data']['user_id']
-        user = User.objects.get(user_id__exact=user_id)
+        ttl = decoded['data']['exp'] - time.time()
+        user = _user_cache.get(user_id)
+        if user is not None:
+            return user
+        shared = shared_cache()
+        if shared is not None:
+            user = shared.get(_user_key(user_id))
+        if user is None:
+            user = User.objects.get(user_id__exact=user_id)
+            if shared is not None:
+                shared.set(_user_key(user_id), user, min(ttl, settings.USER_CACHE_SHARED_TTL))
+        _user_cache.set(user_id, user, ttl)
         return user
     else:
         return None
 
 
+def invalidate_user(user_id):
+    """用户资料 / 角色变更或删除后清掉缓存快照"""
+    _user_cache.delete(int(user_id))
+    shared = shared_cache()
+    if shared is not None:
+        shared.delete(_user_key(user_id))
+
+
 # def get_user_by_r_token(r_token):
 #     decoded = token.decode_refresh_token(r_token)
 #     if decoded['state'] == 1: